@@ -0,0 +1,48 @@
+"""Benchmark suite for the file API.
+
+Runs against the database from .env, the app in-process (asgi), behind uvicorn on a local socket,
+or an already running server (--url):
+
+    python -m benchmarks transfer --transport socket --sizes 1K:50,1M:30,1G:1 --files 50
+    python -m benchmarks all --out before.json
+    python -m benchmarks.compare before.json after.json
+
+Every run prints (or writes with --out) JSON with throughput, p50/p95/p99 latency and peak RSS.
+"""
+import argparse
+import asyncio
+import json
+
+from benchmarks import archives, auth, list_files, serialize, transfer
+from benchmarks.common import add_client_arguments, report
+
+BENCHMARKS = {'auth': auth, 'list': list_files, 'serialize': serialize, 'transfer': transfer, 'archive': archives}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    for name, module in [*BENCHMARKS.items(), ('all', None)]:
+        subparser = subparsers.add_parser(name, help=(module.__doc__ or 'Run every benchmark').splitlines()[0])
+        add_client_arguments(subparser)
+        subparser.add_argument('--out', default=None, help='Write the JSON report to this file')
+        for each in ([module] if module else BENCHMARKS.values()):
+            each.add_arguments(subparser)
+    return parser.parse_args(argv)
+
+
+async def main(args: argparse.Namespace) -> list[dict]:
+    names = list(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+    reports = []
+    for name in names:
+        reports.append(report(name, args, await BENCHMARKS[name].run(args)))
+    return reports
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    output = json.dumps(asyncio.run(main(arguments)), indent=2)
+    if arguments.out:
+        with open(arguments.out, 'w') as file:
+            file.write(output + '\n')
+    print(output)
@@ -0,0 +1,73 @@
+"""Downloads of a deep directory tree as zip, tar and 7z archives.
+
+The tree is uploaded once as a tar through POST /files/batch.
+"""
+import argparse
+import io
+import random
+import tarfile
+import time
+import uuid
+
+from benchmarks.common import make_client, new_user, parse_size, summary
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--files-per-dir', type=int, default=2)
+    parser.add_argument('--file-size', default='16K')
+    parser.add_argument('--codecs', default='zip,tar,7z')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--archive-cache', action='store_true', help='Keep the archive cache on (in-process only)')
+
+
+def build_tree(depth: int, fanout: int, files_per_dir: int, file_size: int, seed: int) -> tuple[bytes, int, int]:
+    generator = random.Random(seed)
+    buffer = io.BytesIO()
+    files = total = 0
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        directories = ['']
+        for _ in range(depth):
+            directories = [f'{parent}d{index}/' for parent in directories for index in range(fanout)]
+            for directory in directories:
+                for index in range(files_per_dir):
+                    content = generator.randbytes(file_size)
+                    info = tarfile.TarInfo(f'{directory}f{index}.bin')
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+                    files += 1
+                    total += len(content)
+    return buffer.getvalue(), files, total
+
+
+async def run(args: argparse.Namespace) -> dict:
+    if not args.url and not args.archive_cache:
+        from src.core.config import settings
+        settings.archive_cache_enabled = False
+    tree, files, total = build_tree(args.depth, args.fanout, args.files_per_dir, parse_size(args.file_size),
+                                    args.seed)
+    folder = f'/bench_archive_{uuid.uuid4().hex[:8]}'
+    results = {'files': files, 'bytes': total}
+    async with make_client(args) as client:
+        headers = await new_user(client, 'bench_archive')
+        started = time.perf_counter()
+        response = await client.post('/api/v1/files/batch', params={'path': folder}, headers=headers,
+                                     files={'archive': ('tree.tar', tree)})
+        response.raise_for_status()
+        results['batch_upload'] = summary([time.perf_counter() - started], time.perf_counter() - started, total)
+        for codec in args.codecs.split(','):
+            latencies, archive_bytes = [], 0
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                request_started = time.perf_counter()
+                async with client.stream('GET', '/api/v1/files/download', headers=headers,
+                                         params={'path': folder, 'compression': codec}) as response:
+                    response.raise_for_status()
+                    archive_bytes = 0
+                    async for chunk in response.aiter_raw():
+                        archive_bytes += len(chunk)
+                latencies.append(time.perf_counter() - request_started)
+            results[codec] = {'archive_bytes': archive_bytes,
+                              **summary(latencies, time.perf_counter() - started, total * args.repeat)}
+    return results
@@ -0,0 +1,36 @@
+"""Register and auth storms, then an authenticated request storm that exercises the user cache."""
+import argparse
+import uuid
+
+from benchmarks.common import make_client, summary, timed
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--logins', type=int, default=1000)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    prefix = uuid.uuid4().hex[:8]
+    users = [{'username': f'bench_{prefix}_{index}', 'password': 'bench-pass'} for index in range(args.users)]
+    tokens = {}
+
+    async def register(index: int) -> None:
+        response = await client.post('/api/v1/register/', json=users[index])
+        response.raise_for_status()
+
+    async def login(index: int) -> None:
+        response = await client.post('/api/v1/auth/', json=users[index % len(users)])
+        response.raise_for_status()
+        tokens[index % len(users)] = response.json()['access_token']
+
+    async def authorized(index: int) -> None:
+        token = tokens[index % len(tokens)]
+        response = await client.get('/api/v1/files/usage', headers={'Authorization': f'Bearer {token}'})
+        response.raise_for_status()
+
+    async with make_client(args) as client:
+        register_results = summary(*await timed(len(users), args.concurrency, register))
+        login_results = summary(*await timed(args.logins, args.concurrency, login))
+        authorized_results = summary(*await timed(args.logins, args.concurrency, authorized))
+    return {'register': register_results, 'auth': login_results, 'authorized_request': authorized_results}
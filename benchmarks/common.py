@@ -0,0 +1,160 @@
+"""Shared pieces of the benchmarks: clients, users, timing and the JSON report."""
+import argparse
+import asyncio
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from httpx import AsyncClient
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def pick(q: float) -> float:
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+
+    return {'count': len(samples), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'mean_ms': round(statistics.fmean(samples) * 1000, 3)}
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper().removesuffix('B')
+    unit = value[-1] if value and value[-1] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_distribution(value: str) -> list[tuple[int, float]]:
+    """"1K:50,1M:30,1G:1" -> [(size, weight), ...]; a size without weight counts 1."""
+    distribution = []
+    for part in value.split(','):
+        size, _, weight = part.partition(':')
+        distribution.append((parse_size(size), float(weight or 1)))
+    return distribution
+
+
+def pick_sizes(distribution: list[tuple[int, float]], count: int, seed: int) -> list[int]:
+    sizes, weights = zip(*distribution)
+    return random.Random(seed).choices(sizes, weights=weights, k=count)
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(benchmark: str, args: argparse.Namespace, results: dict) -> dict:
+    return {
+        'benchmark': benchmark,
+        'commit': git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key != 'func'},
+        'results': results,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def add_client_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--transport', choices=('asgi', 'socket'), default='asgi',
+                        help='asgi calls the app in-process, socket serves it with uvicorn on a local port')
+    parser.add_argument('--url', default=None, help='Benchmark an already running server instead')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+
+
+@asynccontextmanager
+async def make_client(args: argparse.Namespace) -> AsyncIterator[AsyncClient]:
+    if args.url:
+        async with AsyncClient(base_url=args.url, timeout=None) as client:
+            yield client
+        return
+    from src.core.config import settings
+    from src.main import app
+    # downloads have to come from the app itself, there is no static server next to the benchmark
+    settings.download_mode = 'stream'
+    if args.transport == 'asgi':
+        async with AsyncClient(app=app, base_url='http://bench', timeout=None) as client:
+            yield client
+        return
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning'))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        async with AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=None) as client:
+            yield client
+    finally:
+        server.should_exit = True
+        await serving
+
+
+async def new_user(client: AsyncClient, prefix: str = 'bench') -> dict:
+    """Registers a fresh user and returns its Authorization header."""
+    credentials = {'username': f'{prefix}_{uuid.uuid4().hex[:12]}', 'password': 'bench-pass'}
+    await client.post('/api/v1/register/', json=credentials)
+    response = await client.post('/api/v1/auth/', json=credentials)
+    response.raise_for_status()
+    return {'Authorization': 'Bearer ' + response.json()['access_token']}
+
+
+async def timed(count: int, concurrency: int, call: Callable[[int], Awaitable[object]]) -> tuple[list[float], float]:
+    """Runs call(0..count-1) with at most concurrency in flight; returns latencies and wall time."""
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index: int) -> None:
+        async with slots:
+            started = time.perf_counter()
+            await call(index)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(count)))
+    return latencies, time.perf_counter() - started
+
+
+def summary(latencies: list[float], wall_seconds: float, transferred: int = 0) -> dict:
+    result = {'requests_per_second': round(len(latencies) / wall_seconds, 2) if wall_seconds else None,
+              'wall_seconds': round(wall_seconds, 3), **percentiles(latencies)}
+    if transferred:
+        result['bytes'] = transferred
+        result['megabytes_per_second'] = round(transferred / wall_seconds / 1024 ** 2, 2)
+    return result
+
+
+def write_random_file(path: str, size: int, seed: int, chunk_size: int = 1024 * 1024) -> None:
+    """Incompressible content, generated in chunks so gigabyte files do not sit in memory."""
+    generator = random.Random(seed)
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining:
+            count = min(chunk_size, remaining)
+            file.write(generator.randbytes(count))
+            remaining -= count
@@ -0,0 +1,67 @@
+"""Compares two benchmark reports and flags regressions.
+
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+
+Latencies (*_ms, *_seconds) that grew and throughputs (*_per_second) that dropped by more than
+the threshold are regressions; the exit code is 1 when there is any.
+"""
+import argparse
+import json
+import sys
+from typing import Iterator
+
+
+def load(path: str) -> dict[str, dict]:
+    with open(path) as file:
+        reports = json.load(file)
+    if isinstance(reports, dict):
+        reports = [reports]
+    return {report['benchmark']: report for report in reports}
+
+
+def flatten(value: object, prefix: str = '') -> Iterator[tuple[str, float]]:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}.{key}' if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def direction(key: str) -> int:
+    """1 when bigger is better, -1 when smaller is better, 0 when the metric is not compared."""
+    name = key.rsplit('.', 1)[-1]
+    if name.endswith('_per_second'):
+        return 1
+    if name.endswith('_ms') or name.endswith('_seconds') or name == 'peak_rss_bytes':
+        return -1
+    return 0
+
+
+def compare(before: dict[str, dict], after: dict[str, dict], threshold: float) -> dict:
+    changes, regressions = {}, []
+    for benchmark in before.keys() & after.keys():
+        old = dict(flatten({'results': before[benchmark]['results'],
+                            'peak_rss_bytes': before[benchmark]['peak_rss_bytes']}))
+        new = dict(flatten({'results': after[benchmark]['results'],
+                            'peak_rss_bytes': after[benchmark]['peak_rss_bytes']}))
+        for key in sorted(old.keys() & new.keys()):
+            better = direction(key)
+            if not better or not old[key]:
+                continue
+            change = (new[key] - old[key]) / old[key]
+            name = f'{benchmark}.{key}'
+            changes[name] = {'before': old[key], 'after': new[key], 'change': round(change, 4)}
+            if -better * change > threshold:
+                regressions.append(name)
+    return {'threshold': threshold, 'regressions': regressions, 'changes': changes}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    result = compare(load(args.before), load(args.after), args.threshold)
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result['regressions'] else 0)
@@ -0,0 +1,93 @@
+"""Listing and directory queries over one user with many files.
+
+Rows are inserted straight into the database, so seeding 100k files takes seconds.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from uuid import UUID, uuid4
+
+from httpx import AsyncClient
+from sqlalchemy import insert
+
+from benchmarks.common import make_client, new_user, summary, timed
+
+SEED_BATCH = 5000
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--rows', type=int, default=100_000, help='Files of the listed user')
+    parser.add_argument('--directories', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per first-page/prefix scenario')
+
+
+async def seed(user_id: UUID, files: int, directories: int, seed_value: int) -> float:
+    from src.db.db import async_session
+    from src.models.models import File
+
+    generator = random.Random(seed_value)
+    started_at = datetime.utcnow() - timedelta(days=1)
+    started = time.perf_counter()
+    async with async_session() as session:
+        for first in range(0, files, SEED_BATCH):
+            rows = []
+            for index in range(first, min(first + SEED_BATCH, files)):
+                parent = f'bench/d{index % directories}/s{index % 7}'
+                rows.append({'id': uuid4(), 'user_id': user_id, 'name': f'f{index}.bin',
+                             'path': f'{parent}/f{index}.bin', 'parent': parent,
+                             'size': generator.randint(1, 10 * 1024 ** 2), 'digest': None,
+                             'is_downloadable': True, 'created_at': started_at + timedelta(milliseconds=index)})
+            await session.execute(insert(File), rows)
+        await session.commit()
+    return time.perf_counter() - started
+
+
+async def scan(client: AsyncClient, headers: dict, page_size: int) -> tuple[list[float], float, int]:
+    latencies, rows, cursor = [], 0, None
+    started = time.perf_counter()
+    while True:
+        params = {'limit': page_size, **({'cursor': cursor} if cursor else {})}
+        request_started = time.perf_counter()
+        response = await client.get('/api/v1/files/', params=params, headers=headers)
+        latencies.append(time.perf_counter() - request_started)
+        response.raise_for_status()
+        page = response.json()
+        rows += len(page['files'])
+        cursor = page['next_cursor']
+        if not cursor:
+            return latencies, time.perf_counter() - started, rows
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = {}
+    async with make_client(args) as client:
+        headers = await new_user(client, 'bench_list')
+        account = (await client.get('/api/v1/files/', params={'limit': 1}, headers=headers)).json()['account_id']
+        results['seed_seconds'] = round(await seed(UUID(account), args.rows, args.directories, args.seed), 3)
+
+        for sort in ('created_at', 'size', 'name'):
+            async def first_page(index: int, sort: str = sort) -> None:
+                response = await client.get('/api/v1/files/', params={'limit': 100, 'sort': sort, 'order': 'desc'},
+                                            headers=headers)
+                response.raise_for_status()
+
+            results[f'first_page_{sort}'] = summary(*await timed(args.requests, args.concurrency, first_page))
+
+        async def prefix(index: int) -> None:
+            response = await client.get('/api/v1/files/', params={'prefix': f'/bench/d{index % args.directories}'},
+                                        headers=headers)
+            response.raise_for_status()
+
+        async def directory(index: int) -> None:
+            response = await client.get('/api/v1/files/directory',
+                                        params={'path': f'/bench/d{index % args.directories}'}, headers=headers)
+            response.raise_for_status()
+
+        results['prefix_page'] = summary(*await timed(args.requests, args.concurrency, prefix))
+        results['directory_info'] = summary(*await timed(args.requests, args.concurrency, directory))
+        latencies, wall_seconds, rows = await scan(client, headers, args.page_size)
+        results['full_scan'] = {'rows': rows, 'rows_per_second': round(rows / wall_seconds, 2),
+                                **summary(latencies, wall_seconds)}
+    return results
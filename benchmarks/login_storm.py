@@ -0,0 +1,75 @@
+"""Latency of an unrelated endpoint while a storm of logins runs on the same worker.
+
+Runs the app in-process against the database from .env:
+
+    python -m benchmarks.login_storm --logins 200 --concurrency 50
+
+Prints JSON with p50/p95/p99 of GET /api/v1/ measured with and without the storm.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from httpx import AsyncClient
+
+from benchmarks.common import percentiles
+from src.main import app
+
+
+async def probe(client: AsyncClient, stop: asyncio.Event, interval: float) -> list[float]:
+    samples = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get('/api/v1/')
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return samples
+
+
+async def storm(client: AsyncClient, credentials: dict, logins: int, concurrency: int) -> None:
+    slots = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with slots:
+            await client.post('/api/v1/auth/', json=credentials)
+
+    await asyncio.gather(*(login() for _ in range(logins)))
+
+
+async def main(args: argparse.Namespace) -> dict:
+    credentials = {'username': f'bench_{uuid.uuid4().hex[:8]}', 'password': 'bench-pass'}
+    async with AsyncClient(app=app, base_url='http://bench') as client:
+        await client.post('/api/v1/register/', json=credentials)
+
+        stop = asyncio.Event()
+        idle = asyncio.create_task(probe(client, stop, args.interval))
+        await asyncio.sleep(args.idle_seconds)
+        stop.set()
+        baseline = await idle
+
+        stop = asyncio.Event()
+        loaded = asyncio.create_task(probe(client, stop, args.interval))
+        start = time.perf_counter()
+        await storm(client, credentials, args.logins, args.concurrency)
+        storm_seconds = time.perf_counter() - start
+        stop.set()
+        under_storm = await loaded
+    return {
+        'benchmark': 'login_storm',
+        'logins': args.logins,
+        'concurrency': args.concurrency,
+        'logins_per_second': round(args.logins / storm_seconds, 2),
+        'probe_idle': percentiles(baseline),
+        'probe_under_storm': percentiles(under_storm),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.005, help='Pause between probe requests, seconds')
+    parser.add_argument('--idle-seconds', type=float, default=2.0)
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
@@ -0,0 +1,74 @@
+"""Listing serialization: the pydantic path against the orjson fast path, without the database.
+
+The pydantic path is what GET /files/ did before: an ORM object per row, File.from_orm().dict(),
+validation against the untyped FilesList response model and ORJSONResponse. The fast path encodes
+the column tuples of get_list_files with encode_files_page.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+from uuid import UUID, uuid4
+
+from pydantic import BaseModel
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--page-rows', type=int, default=100_000, help='Files in the serialized page')
+    parser.add_argument('--passes', type=int, default=5, help='Best of this many runs per path')
+
+
+class LegacyFilesList(BaseModel):
+    account_id: UUID
+    files: List
+    next_cursor: Optional[str] = None
+
+
+def make_rows(count: int) -> list[tuple]:
+    started_at = datetime.utcnow() - timedelta(days=1)
+    return [(uuid4(), f'f{index}.bin', started_at + timedelta(milliseconds=index),
+             f'bench/d{index % 100}/f{index}.bin', index * 1024, None, True) for index in range(count)]
+
+
+async def pydantic_path(account_id: UUID, rows: list[tuple]) -> bytes:
+    from fastapi.responses import ORJSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    from src.models.models import File
+    from src.schemes import file_schemes
+    from src.services.file import LIST_COLUMNS
+
+    objects = [File(**dict(zip(LIST_COLUMNS, row))) for row in rows]
+    files = [file_schemes.File.from_orm(file).dict() for file in objects]
+    field = create_response_field(name='Response_get_files_list', type_=LegacyFilesList)
+    response_content = {'account_id': account_id, 'files': files, 'next_cursor': None}
+    content = await serialize_response(field=field, response_content=response_content)
+    return ORJSONResponse(content).body
+
+
+async def fast_path(account_id: UUID, rows: list[tuple]) -> bytes:
+    from src.services.file import encode_files_page
+
+    return encode_files_page(account_id, rows, None)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import orjson
+
+    account_id = uuid4()
+    rows = make_rows(args.page_rows)
+    results = {}
+    bodies = {}
+    for name, path in (('pydantic', pydantic_path), ('orjson', fast_path)):
+        timings = []
+        for _ in range(args.passes):
+            started = time.perf_counter()
+            bodies[name] = await path(account_id, rows)
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        results[name] = {'best_seconds': round(best, 4), 'rows_per_second': round(args.page_rows / best, 2),
+                         'body_bytes': len(bodies[name])}
+    results['same_json'] = orjson.loads(bodies['pydantic']) == orjson.loads(bodies['orjson'])
+    results['speedup'] = round(results['pydantic']['best_seconds'] / results['orjson']['best_seconds'], 2)
+    return results
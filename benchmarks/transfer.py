@@ -0,0 +1,64 @@
+"""Uploads and downloads of files drawn from a size distribution.
+
+The asgi transport keeps whole responses in memory; use --transport socket for files of gigabytes.
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+from benchmarks.common import (make_client, new_user, parse_distribution, percentiles, pick_sizes, summary, timed,
+                               write_random_file)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--sizes', default='1K:50,64K:30,1M:15,16M:5',
+                        help='size:weight list, e.g. 1K:50,1M:30,100M:5,1G:1')
+    parser.add_argument('--files', type=int, default=100)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    sizes = pick_sizes(parse_distribution(args.sizes), args.files, args.seed)
+    folder = f'/bench_transfer_{uuid.uuid4().hex[:8]}'
+    by_size = defaultdict(lambda: {'upload': [], 'download': []})
+    with tempfile.TemporaryDirectory(prefix='bench-') as tmp:
+        # one source file per distinct size, each upload goes to its own path
+        sources = {}
+        for size in set(sizes):
+            sources[size] = os.path.join(tmp, f'{size}.bin')
+            write_random_file(sources[size], size, args.seed + size)
+
+        async with make_client(args) as client:
+            headers = await new_user(client, 'bench_transfer')
+
+            async def upload(index: int) -> None:
+                started = time.perf_counter()
+                with open(sources[sizes[index]], 'rb') as file:
+                    response = await client.post('/api/v1/files/upload', headers=headers,
+                                                 params={'path': f'{folder}/{index}.bin'},
+                                                 files={'file': (f'{index}.bin', file)})
+                response.raise_for_status()
+                by_size[sizes[index]]['upload'].append(time.perf_counter() - started)
+
+            async def download(index: int) -> None:
+                started = time.perf_counter()
+                async with client.stream('GET', '/api/v1/files/download', headers=headers,
+                                         params={'path': f'{folder}/{index}.bin'}) as response:
+                    response.raise_for_status()
+                    received = 0
+                    async for chunk in response.aiter_raw():
+                        received += len(chunk)
+                if received != sizes[index]:
+                    raise RuntimeError(f'Downloaded {received} bytes of {sizes[index]}')
+                by_size[sizes[index]]['download'].append(time.perf_counter() - started)
+
+            upload_results = summary(*await timed(len(sizes), args.concurrency, upload), transferred=sum(sizes))
+            download_results = summary(*await timed(len(sizes), args.concurrency, download), transferred=sum(sizes))
+    return {
+        'upload': upload_results,
+        'download': download_results,
+        'by_size': {str(size): {direction: percentiles(samples) for direction, samples in directions.items()}
+                    for size, directions in sorted(by_size.items())},
+    }
@@ -0,0 +1,35 @@
+"""Add users storage usage
+
+Revision ID: 1d6b0c7f4e92
+Revises: e7f3b5a09d21
+Create Date: 2026-10-18 20:05:13.418270
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1d6b0c7f4e92'
+down_revision: Union[str, None] = 'e7f3b5a09d21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('quota_bytes', sa.BigInteger(), nullable=True))
+    op.add_column('users', sa.Column('used_bytes', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('files_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute(
+        "UPDATE users SET used_bytes = totals.used_bytes, files_count = totals.files_count "
+        "FROM (SELECT user_id, sum(size) AS used_bytes, count(*) AS files_count FROM files GROUP BY user_id) totals "
+        "WHERE totals.user_id = users.id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'files_count')
+    op.drop_column('users', 'used_bytes')
+    op.drop_column('users', 'quota_bytes')
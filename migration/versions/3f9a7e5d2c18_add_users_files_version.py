@@ -0,0 +1,28 @@
+"""Add users files version
+
+Revision ID: 3f9a7e5d2c18
+Revises: 8a4f2d6c1b37
+Create Date: 2026-10-18 23:26:48.105392
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9a7e5d2c18'
+down_revision: Union[str, None] = '8a4f2d6c1b37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('files_version', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('files_changed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'files_changed_at')
+    op.drop_column('users', 'files_version')
@@ -0,0 +1,31 @@
+"""Add files parent path
+
+Revision ID: e7f3b5a09d21
+Revises: c4a8d2e61f05
+Create Date: 2026-10-18 15:48:52.061377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7f3b5a09d21'
+down_revision: Union[str, None] = 'c4a8d2e61f05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('parent', sa.String(length=255), server_default='', nullable=False))
+    op.execute("UPDATE files SET parent = regexp_replace(path, '/?[^/]*$', '')")
+    op.alter_column('files', 'parent', server_default=None)
+    op.create_index('ix_files_user_id_parent', 'files', ['user_id', 'parent'], unique=False,
+                    postgresql_ops={'parent': 'varchar_pattern_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_files_user_id_parent', table_name='files')
+    op.drop_column('files', 'parent')
@@ -4,6 +4,8 @@ from .auth import auth_router
 from .ping import ping_db_router
 from .files import files_router
 from .register import register_router
+from .uploads import uploads_router
+from .metrics import metrics_router
 from starlette.responses import JSONResponse
 
 api_router = APIRouter()
@@ -25,3 +27,5 @@ api_router.include_router(auth_router, prefix="/auth", tags=["auth"])
 api_router.include_router(register_router, prefix="/register", tags=["register"])
 api_router.include_router(ping_db_router, prefix="/ping", tags=["ping"])
 api_router.include_router(files_router, prefix="/files", tags=["files"])
+api_router.include_router(uploads_router, prefix="/files/uploads", tags=["files"])
+api_router.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
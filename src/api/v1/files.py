@@ -1,46 +1,213 @@
+import hashlib
+import mimetypes
+import os
+from datetime import datetime
 from typing import Any, Annotated, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import APIRouter, Depends, status, HTTPException, File, UploadFile, Query
+from fastapi import APIRouter, Depends, status, HTTPException, Query, Request
 from fastapi.security import HTTPBearer
-from starlette.responses import RedirectResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 
 from src.core import settings
 from src.core.logger import logger
 from src.db.db import get_session
 from src.schemes import user_schemes, file_schemes
-from src.services.base import user_service, file_service
-from src.utils.tools import is_valid_uuid
+from src.services.base import user_service, file_service, quota_service
+from src.services.file import encode_files_page
+from src.utils.multipart import MultipartFileStream
+from src.utils.responses import (RangeFileResponse, is_not_modified, not_modified_response, utc_timestamp,
+                                 validator_headers)
+from src.utils.tools import content_disposition, encode_stream, is_valid_uuid, negotiate_encoding
 
 files_router = APIRouter()
 security = HTTPBearer()
 
 
-@files_router.get('/', response_model=file_schemes.FilesList, description='Get files list for user')
-async def get_files_list(*, db: AsyncSession = Depends(get_session),
+LISTING_CACHE_CONTROL = {'cache-control': 'private, no-cache'}
+
+
+async def listing_validators(request: Request, db: AsyncSession,
+                             current_user: user_schemes.CurrentUser) -> tuple[str, Optional[float]]:
+    """ETag and Last-Modified of a listing from the user's files version, one primary key lookup.
+
+    The version is read before the rows, so a concurrent change can only make the next poll load again.
+    """
+    version, changed_at = await quota_service.get_files_version(db=db, user_id=current_user.id)
+    key = hashlib.blake2b(f'{current_user.id} {request.url.path} {sorted(request.query_params.multi_items())}'
+                          .encode(), digest_size=8).hexdigest()
+    return f'W/"{version}-{key}"', utc_timestamp(changed_at) if changed_at else None
+
+
+@files_router.get('/', response_model=file_schemes.FilesList, description='Get files list for user',
+                  responses={304: {'description': 'Not modified since the ETag or date of the request'}})
+async def get_files_list(*, db: AsyncSession = Depends(get_session), request: Request,
                          current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
-                         authorization: str = Depends(security)) -> Any:
-    files = await file_service.get_list_files(db=db, user_obj=current_user)
-    data = {'account_id': current_user.id, 'files': files}
-    return data
+                         authorization: str = Depends(security),
+                         limit: int = Query(default=settings.files_page_size, ge=1, le=settings.files_page_max_size,
+                                            description='Page size'),
+                         cursor: Optional[str] = Query(default=None, description='next_cursor of the previous page'),
+                         prefix: Optional[str] = Query(default=None, description='Only files under this path'),
+                         sort: str = Query(default='created_at', description='Sort by: created_at, size, name'),
+                         order: str = Query(default='asc', description='Order: asc, desc')) -> Any:
+    etag, last_modified = await listing_validators(request, db, current_user)
+    if is_not_modified(request.headers, etag, last_modified):
+        return not_modified_response(etag, last_modified, LISTING_CACHE_CONTROL)
+    files, next_cursor = await file_service.get_list_files(db=db, user_obj=current_user, limit=limit, sort=sort,
+                                                           order=order, prefix=prefix, cursor=cursor)
+    # response_model only documents the body, the rows are encoded without validating them again
+    return Response(encode_files_page(current_user.id, files, next_cursor), media_type='application/json',
+                    headers={**validator_headers(etag, last_modified), **LISTING_CACHE_CONTROL})
+
+
+@files_router.get('/directory', response_model=file_schemes.DirectoryInfo,
+                  description='Get directory contents with recursive sizes and file counts',
+                  responses={304: {'description': 'Not modified since the ETag or date of the request'}})
+async def get_directory_info(*, db: AsyncSession = Depends(get_session), request: Request, response: Response,
+                             current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                             authorization: str = Depends(security),
+                             path: str = Query(default='/', description='Enter path like "/folder"')) -> Any:
+    etag, last_modified = await listing_validators(request, db, current_user)
+    if is_not_modified(request.headers, etag, last_modified):
+        return not_modified_response(etag, last_modified, LISTING_CACHE_CONTROL)
+    response.headers.update({**validator_headers(etag, last_modified), **LISTING_CACHE_CONTROL})
+    return await file_service.get_directory_info(db=db, user_obj=current_user, path=path)
+
+
+@files_router.get('/export',
+                  description='Stream all files of the user as newline delimited JSON, '
+                              'zstd or gzip encoded when Accept-Encoding allows',
+                  response_class=StreamingResponse,
+                  responses={200: {'content': {'application/x-ndjson': {'schema': file_schemes.File.schema()}}}})
+async def export_files(*, db: AsyncSession = Depends(get_session), request: Request,
+                       current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                       authorization: str = Depends(security),
+                       since: Optional[datetime] = Query(default=None,
+                                                         description='Only files written after this time, '
+                                                                     'e.g. created_at of the last exported line')
+                       ) -> StreamingResponse:
+    # the export reads through its own session for as long as the body streams
+    await db.close()
+    body = file_service.export_files(user_obj=current_user, since=since)
+    headers = {'vary': 'Accept-Encoding'}
+    encoding = negotiate_encoding(request.headers.get('accept-encoding', ''))
+    if encoding:
+        body = encode_stream(body, encoding)
+        headers['content-encoding'] = encoding
+    logger.info('Export files of %s since %s', current_user.id, since)
+    return StreamingResponse(body, media_type='application/x-ndjson', headers=headers)
+
+
+@files_router.get('/usage', response_model=file_schemes.StorageUsage, description='Get used storage and quota')
+async def get_usage(*, db: AsyncSession = Depends(get_session),
+                    current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                    authorization: str = Depends(security)) -> Any:
+    return await quota_service.get_usage(db=db, user_id=current_user.id)
+
+
+async def check_quota(request: Request, db: AsyncSession = Depends(get_session),
+                      current_user: user_schemes.CurrentUser = Depends(user_service.get_current_user)) -> None:
+    """Rejects an upload whose Content-Length alone does not fit into the quota, less a file it overwrites.
+
+    Closes the request session afterwards: no connection is held while the body is received, the
+    file record is written in a new transaction on a connection checked out at that point.
+    """
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit():
+        replaced = await file_service.get_replaced_size(db=db, user_obj=current_user,
+                                                        path=request.query_params.get('path', ''))
+        await quota_service.check(db=db, user_id=current_user.id, incoming=int(content_length), replaced=replaced)
+    await db.close()
+
+
+UPLOAD_BODY = {
+    'requestBody': {
+        'required': True,
+        'content': {'multipart/form-data': {'schema': {
+            'type': 'object',
+            'required': ['file'],
+            'properties': {'file': {'type': 'string', 'format': 'binary'}},
+        }}},
+    },
+}
 
 
 @files_router.post('/upload', response_model=file_schemes.FileInDB, status_code=status.HTTP_201_CREATED,
-                   description='Get token for user.')
-async def upload_file(*, db: AsyncSession = Depends(get_session),
+                   description='Upload a file, streamed to storage while it is received',
+                   dependencies=[Depends(check_quota)], openapi_extra=UPLOAD_BODY)
+async def upload_file(*, db: AsyncSession = Depends(get_session), request: Request,
                       path: str = Query(description='Enter path to directory OR file'),
                       current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
-                      authorization: str = Depends(security), file: UploadFile = File(...)) -> Any:
+                      authorization: str = Depends(security)) -> Any:
     if path.startswith('/'):
         path = path[1:]
     if path.startswith('\\'):
         path = path[2:]
+    file = MultipartFileStream(request.headers, request.stream())
     file_obj = await file_service.create_file(db=db, user_obj=current_user, file_obj=file, file_path=path)
     logger.info('Upload/put file %s from %s', path, current_user.id)
     return file_obj
 
 
+BATCH_BODY = {
+    'requestBody': {
+        'content': {'multipart/form-data': {'schema': {
+            'type': 'object',
+            'properties': {
+                'files': {'type': 'array', 'items': {'type': 'string', 'format': 'binary'},
+                          'description': 'Names are relative paths'},
+                'archive': {'type': 'string', 'format': 'binary', 'description': 'tar, tar.gz'},
+            },
+        }}},
+    },
+}
+
+
+@files_router.post('/batch', response_model=file_schemes.BatchResult, dependencies=[Depends(check_quota)],
+                   description='Upload many files, or a tar archive unpacked on the server, in one request',
+                   openapi_extra=BATCH_BODY)
+async def upload_files_batch(*, db: AsyncSession = Depends(get_session), request: Request,
+                             path: str = Query(default='/', description='Enter path to directory'),
+                             current_user: Annotated[user_schemes.CurrentUser,
+                                                     Depends(user_service.get_current_user)],
+                             authorization: str = Depends(security)) -> Any:
+    # the form is read here rather than declared as parameters, so check_quota runs before the body is spooled
+    async with request.form(max_files=settings.batch_upload_max_files + 2) as form:
+        files = [part for part in form.getlist('files') if isinstance(part, UploadFile)]
+        archive = form.get('archive')
+        if not isinstance(archive, UploadFile):
+            archive = None
+        if not files and archive is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Send files or an archive.'
+            )
+        items = await file_service.create_files_batch(db=db, user_obj=current_user, directory=path, files=files,
+                                                      archive=archive)
+    created = sum(item['status'] == status.HTTP_201_CREATED for item in items)
+    updated = sum(item['status'] == status.HTTP_200_OK for item in items)
+    logger.info('Batch upload of %s items to %s from %s', len(items), path, current_user.id)
+    return {'created': created, 'updated': updated, 'failed': len(items) - created - updated, 'items': items}
+
+
+@files_router.delete('/', status_code=status.HTTP_204_NO_CONTENT, description='Delete file')
+async def delete_file(*, db: AsyncSession = Depends(get_session),
+                      current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                      authorization: str = Depends(security),
+                      path: str = Query(description='Enter path like "/folder/to/file" OR file id')) -> Response:
+    if not path.startswith('/') and not is_valid_uuid(path):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Path must starts with or check uid.'
+        )
+    await file_service.delete_file(db=db, user_obj=current_user, path=path)
+    logger.info('Delete file %s from %s', path, current_user.id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
 @files_router.get('/download', status_code=status.HTTP_200_OK, description='Download file')
-async def download_file(*, db: AsyncSession = Depends(get_session),
+async def download_file(*, db: AsyncSession = Depends(get_session), request: Request,
                         current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
                         authorization: str = Depends(security),
                         path: str = Query(description='Enter path like "/folder/to/file" OR file id'),
@@ -55,13 +222,61 @@ async def download_file(*, db: AsyncSession = Depends(get_session),
     logger.info(f'Download obj {path}')
     if compression:
         logger.info(f'Download in compression type {compression}')
-        refreshed_io, media_type, arch_name = await file_service.get_compression_file(db=db, path=path,
-                                                                                      compression_type=compression)
+        archive, media_type, arch_name = await file_service.get_compression_file(db=db, user_obj=current_user,
+                                                                                 path=path,
+                                                                                 compression_type=compression)
+        if isinstance(archive, str):
+            etag = '"' + os.path.splitext(os.path.basename(archive))[0] + '"'
+            return serve_stored_file(request, archive, arch_name, media_type, etag, download_mode='stream')
         return StreamingResponse(
-            iter([refreshed_io.getvalue()]),
+            archive,
+            media_type=media_type,
+            headers={"Content-Disposition": content_disposition(arch_name)},
+            background=BackgroundTask(archive.close),
+        )
+    file_obj = await file_service.get_path_of_file(db=db, user_obj=current_user, path=path)
+    await db.close()
+    media_type = mimetypes.guess_type(file_obj.name)[0] or 'application/octet-stream'
+    return serve_stored_file(request, file_service.storage_path(file_obj), file_obj.name, media_type,
+                             file_service.etag(file_obj), last_modified=utc_timestamp(file_obj.created_at))
+
+
+def serve_stored_file(request: Request, storage_path: str, name: str, media_type: str, etag: str,
+                      download_mode: Optional[str] = None, last_modified: Optional[float] = None) -> Response:
+    """Sends a file from files_folder the way download_mode says; redirect mode falls back to download_mode.
+
+    A matching If-None-Match or If-Modified-Since is answered with 304 in every mode.
+    """
+    if is_not_modified(request.headers, etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    storage_path = storage_path.replace('\\', '/')
+    mode = settings.download_mode
+    if mode == 'redirect' and download_mode:
+        mode = download_mode
+    if mode == 'accel':
+        # nginx serves the bytes from its internal location after the ownership check
+        return Response(
+            media_type=media_type,
+            headers={
+                'X-Accel-Redirect': f'{settings.accel_redirect_prefix}/{storage_path}',
+                'Content-Disposition': content_disposition(name),
+                **validator_headers(etag, last_modified),
+            },
+        )
+    if mode == 'stream':
+        full_path = os.path.join(settings.files_folder, storage_path)
+        if not os.path.isfile(full_path):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Directory or file not found'
+            )
+        return RangeFileResponse(
+            full_path,
             media_type=media_type,
-            headers={"Content-Disposition": f'attachment;filename={arch_name}'}
+            etag=etag,
+            range_header=request.headers.get('range'),
+            if_range=request.headers.get('if-range'),
+            headers={'Content-Disposition': content_disposition(name)},
+            last_modified=last_modified,
         )
-    else:
-        file_obj = await file_service.get_path_of_file(db=db, path=path)
-        return RedirectResponse(settings.static_url +'/'+ file_obj.path.replace('\\', '/'))
+    return RedirectResponse(settings.static_url + '/' + storage_path)
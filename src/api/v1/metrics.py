@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from src.utils.metrics import CONTENT_TYPE, registry
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get('/', description='Metrics in the Prometheus text format')
+async def get_metrics():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
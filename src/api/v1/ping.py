@@ -1,29 +1,29 @@
-import time
-from asyncpg import ConnectionDoesNotExistError
-from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import APIRouter, Depends, status
-from sqlalchemy.exc import OperationalError
 from starlette.responses import JSONResponse
 
+from src.core import settings
 from src.core.logger import logger
-from src.db.db import get_session
+from src.db.db import get_session, pool_stats
+from src.utils.health import probe_db, probe_loop, probe_pool, probe_static, probe_storage, run_probes
 
 ping_db_router = APIRouter()
 
 
 @ping_db_router.get("/")
 async def ping(session: AsyncSession = Depends(get_session)):
-    start_time: float = time.time()
-    try:
-        logger.info(f'Ping database')
-        await session.execute(text("SELECT 1"))
-        total_time: float = round(time.time() - start_time, 2) * 1000
-        return JSONResponse(status_code=status.HTTP_200_OK, content={"db": f'{total_time}'})
-    except OperationalError:
-        logger.error(f'Ping database err')
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={'details': 'Error database connection'})
-    except ConnectionDoesNotExistError:
-        logger.error(f'Ping database err')
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'details': 'Connection to database was closed'})
+    """Probes every linked service concurrently; times are in milliseconds."""
+    logger.info('Ping services')
+    results, errors = await run_probes({
+        'db': probe_db(session),
+        'storage': probe_storage(),
+        'pool': probe_pool(pool_stats),
+        'loop': probe_loop(),
+        'static': probe_static(),
+    }, timeout=settings.ping_probe_timeout_seconds)
+    content = {'status': 'degraded' if errors else 'ok', **results}
+    if errors:
+        logger.error(f'Ping degraded: {errors}')
+        content['errors'] = errors
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE if 'db' in errors else status.HTTP_200_OK
+    return JSONResponse(status_code=status_code, content=content)
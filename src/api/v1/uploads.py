@@ -0,0 +1,76 @@
+from typing import Any, Annotated
+from uuid import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Depends, Query, Request, status
+from fastapi.security import HTTPBearer
+
+from src.core.logger import logger
+from src.db.db import get_session
+from src.schemes import file_schemes, upload_schemes, user_schemes
+from src.services.base import file_service, upload_service, user_service
+from src.services.blob import blob_store
+
+uploads_router = APIRouter()
+security = HTTPBearer()
+
+
+@uploads_router.post('/', response_model=upload_schemes.UploadSession, status_code=status.HTTP_201_CREATED,
+                     description='Start resumable upload of a file')
+async def create_upload(*, db: AsyncSession = Depends(get_session),
+                        current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                        authorization: str = Depends(security),
+                        obj_in: upload_schemes.UploadSessionCreate) -> Any:
+    upload = await upload_service.create_session(db=db, user_obj=current_user, obj_in=obj_in)
+    return upload
+
+
+@uploads_router.post('/delta', response_model=upload_schemes.DeltaUploadSession,
+                     status_code=status.HTTP_201_CREATED,
+                     description='Start upload of a new file version from its chunk manifest, returns missing chunks')
+async def create_delta_upload(*, db: AsyncSession = Depends(get_session),
+                              current_user: Annotated[user_schemes.CurrentUser,
+                                                      Depends(user_service.get_current_user)],
+                              authorization: str = Depends(security),
+                              obj_in: upload_schemes.DeltaUploadCreate) -> Any:
+    upload, missing = await upload_service.create_delta_session(db=db, user_obj=current_user, obj_in=obj_in)
+    received = await upload_service.get_received(db=db, session_id=upload.id)
+    return upload_schemes.DeltaUploadSession.from_orm(upload).copy(update={'received': received,
+                                                                           'missing': missing})
+
+
+@uploads_router.get('/{session_id}', response_model=upload_schemes.UploadSession,
+                    description='Get upload session with already received byte ranges')
+async def get_upload(*, db: AsyncSession = Depends(get_session), session_id: UUID,
+                     current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                     authorization: str = Depends(security)) -> Any:
+    upload = await upload_service.get_session(db=db, user_obj=current_user, session_id=session_id)
+    received = await upload_service.get_received(db=db, session_id=upload.id)
+    return upload_schemes.UploadSession.from_orm(upload).copy(update={'received': received})
+
+
+@uploads_router.put('/{session_id}', response_model=upload_schemes.UploadSession,
+                    description='Upload a chunk of the file, raw request body is written at offset')
+async def put_chunk(*, db: AsyncSession = Depends(get_session), session_id: UUID, request: Request,
+                    offset: int = Query(description='Byte offset of the chunk in the file'),
+                    current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                    authorization: str = Depends(security)) -> Any:
+    upload = await upload_service.write_chunk(db=db, user_obj=current_user, session_id=session_id, offset=offset,
+                                              stream=request.stream())
+    received = await upload_service.get_received(db=db, session_id=upload.id)
+    return upload_schemes.UploadSession.from_orm(upload).copy(update={'received': received})
+
+
+@uploads_router.post('/{session_id}/finalize', response_model=file_schemes.FileInDB,
+                     status_code=status.HTTP_201_CREATED, description='Finish upload and create file')
+async def finalize_upload(*, db: AsyncSession = Depends(get_session), session_id: UUID,
+                          current_user: Annotated[user_schemes.CurrentUser, Depends(user_service.get_current_user)],
+                          authorization: str = Depends(security)) -> Any:
+    path, name, digest, size, manifest = await upload_service.finalize(db=db, user_obj=current_user,
+                                                                       session_id=session_id)
+    file_obj = await file_service.add_file_record(db=db, user_obj=current_user, path=path, name=name,
+                                                  digest=digest, size=size,
+                                                  source=upload_service.data_path(session_id))
+    if manifest:
+        await blob_store.index_chunks(db=db, digest=digest, manifest=manifest)
+    logger.info('Finalize upload %s from %s', path, current_user.id)
+    return file_obj
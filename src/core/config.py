@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 from pydantic import BaseSettings
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -11,13 +12,74 @@ class Settings(BaseSettings):
     base_dir: str = BASE_DIR
     db_dsn: str = ...
     db_echo: bool = False
+    log_file: str = 'log.log'
+    log_max_bytes: int = 50 * 1024 * 1024
+    log_backup_count: int = 5
+    log_json: bool = True
+    log_rate_limit_per_second: int = 100
+    log_archive_entries_first: int = 10
+    log_archive_entries_every: int = 1000
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 30 * 60
+    db_pool_pre_ping: bool = False
+    db_pgbouncer: bool = False
     secret_key: str = ...
     algoritm: str = "HS256"
     access_token_expire_minutes: int = 600
+    password_hash_workers: int = os.cpu_count() or 1
+    password_hash_max_pending: int = 64
+    password_hash_wait_timeout: float = 10.0
+    user_cache_size: int = 10000
+    user_cache_ttl_seconds: float = 60.0
+    user_cache_url: Optional[str] = None
     files_folder_name: str = 'files'
     files_folder: str = os.path.join(BASE_DIR, files_folder_name)
+    blobs_folder_name: str = 'blobs'
+    blobs_fanout_depth: int = 2
+    blobs_fanout_width: int = 2
+    upload_chunk_size: int = 1024 * 1024
+    upload_queue_depth: int = 4
+    uploads_folder_name: str = 'uploads'
+    upload_session_ttl_seconds: int = 24 * 60 * 60
+    upload_cleanup_interval_seconds: int = 10 * 60
+    delta_upload_max_chunks: int = 100000
+    delta_upload_max_chunk_size: int = 64 * 1024 * 1024
+    # the chunk_manifest() sizes clients use, files stored by other uploads are chunked with them on demand
+    delta_chunk_min_size: int = 256 * 1024
+    delta_chunk_avg_size: int = 1024 * 1024
+    delta_chunk_max_size: int = 4 * 1024 * 1024
+    files_page_size: int = 100
+    files_page_max_size: int = 1000
+    export_batch_rows: int = 1000
+    batch_upload_max_files: int = 20000
+    batch_upload_parallelism: int = 8
+    default_quota_bytes: Optional[int] = None
+    usage_reconcile_interval_seconds: int = 60 * 60
     compression_types: list = ['zip', '7z', 'tar']
+    archive_chunk_size: int = 1024 * 1024
+    archive_spool_max_size: int = 64 * 1024 * 1024
+    archive_cache_enabled: bool = True
+    archive_cache_folder_name: str = 'archive_cache'
+    archive_cache_max_bytes: int = 10 * 1024 ** 3
+    # temp files of builds untouched for this long are left over from a crashed worker
+    archive_cache_stale_tmp_seconds: int = 3600
+    # archives served within this time are kept even over max bytes, a response may still be reading them
+    archive_cache_min_age_seconds: int = 3600
+    compression_executor: str = 'process'
+    compression_workers: int = os.cpu_count() or 1
+    compression_max_jobs: int = 2 * (os.cpu_count() or 1)
+    compression_queue_size: int = 8
+    compression_wait_timeout: float = 30.0
+    compression_mp_context: str = 'spawn'
+    metrics_enabled: bool = True
+    ping_probe_timeout_seconds: float = 2.0
+    loop_lag_interval_seconds: float = 0.5
     static_url: str = ...
+    download_mode: str = 'redirect'
+    accel_redirect_prefix: str = '/protected_files'
+    download_chunk_size: int = 1024 * 1024
 
     class Config:
         env_file = '.env'
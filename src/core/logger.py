@@ -1,5 +1,78 @@
+import atexit
+import json
 import logging
+import queue
+import threading
+import time
 from logging import config as logging_config
+from logging.handlers import QueueHandler, QueueListener
+
+from src.core.config import settings
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'module': record.module,
+            'func': record.funcName,
+            'line': record.lineno,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most rate records below WARNING per second through from each call site.
+
+    The next record that passes carries the number of dropped ones.
+    """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self._sites: dict[tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        second = int(time.monotonic())
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or site[0] != second:
+                dropped = site[2] if site else 0
+                site = self._sites[key] = [second, 0, 0]
+            else:
+                dropped = 0
+            if site[1] >= self.rate:
+                site[2] += 1
+                return False
+            site[1] += 1
+        if dropped:
+            record.msg = f'{record.msg} ({dropped} similar messages suppressed)'
+        return True
+
+
+class LogSampler:
+    """Decides which of many similar messages to log: the first ones, then one in every."""
+
+    def __init__(self, first: int = 10, every: int = 1000):
+        self.first = first
+        self.every = every
+        self.seen = 0
+
+    def __call__(self) -> bool:
+        self.seen += 1
+        return self.seen <= self.first or self.seen % self.every == 0
+
 
 LOG_CONFIG = {
     "version": 1,
@@ -15,9 +88,11 @@ LOG_CONFIG = {
         },
         "file": {
             "level": "INFO",
-            "class": "logging.FileHandler",
-            "filename": "log.log",
-            "formatter": "fileformat",
+            "class": "logging.handlers.RotatingFileHandler",
+            "filename": settings.log_file,
+            "maxBytes": settings.log_max_bytes,
+            "backupCount": settings.log_backup_count,
+            "formatter": "json" if settings.log_json else "fileformat",
         },
     },
     "formatters": {
@@ -29,9 +104,31 @@ LOG_CONFIG = {
         "fileformat": {
             "format": "%(asctime)s : %(levelname)s  %(module)s  %(funcName)s : %(lineno)d - %(message)s",
             "datefmt": "%d-%m-%Y %I:%M:%S"
-        }
+        },
+        "json": {
+            "()": JsonFormatter,
+        },
     },
 }
 
+
+def setup_queue_logging() -> QueueListener:
+    """Moves the configured root handlers behind a queue drained by a background thread."""
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    if settings.log_rate_limit_per_second:
+        queue_handler.addFilter(RateLimitFilter(settings.log_rate_limit_per_second))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    atexit.register(queue_listener.stop)
+    return queue_listener
+
+
 logging_config.dictConfig(LOG_CONFIG)
+listener = setup_queue_logging()
 logger = logging.getLogger()
@@ -1,3 +1,7 @@
+from typing import Any
+from uuid import uuid4
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 
@@ -5,10 +9,64 @@ from src.core.config import settings
 
 Base = declarative_base()
 
-engine = create_async_engine(url=settings.db_dsn, echo=settings.db_echo, future=True)
+
+def engine_options() -> dict[str, Any]:
+    options = {
+        'pool_size': settings.db_pool_size,
+        'max_overflow': settings.db_max_overflow,
+        'pool_timeout': settings.db_pool_timeout,
+        'pool_recycle': settings.db_pool_recycle,
+        'pool_pre_ping': settings.db_pool_pre_ping,
+    }
+    if settings.db_pgbouncer:
+        # pgbouncer in transaction mode hands each transaction to any server connection,
+        # so named prepared statements must not be cached or reused across transactions
+        options['connect_args'] = {
+            'statement_cache_size': 0,
+            'prepared_statement_cache_size': 0,
+            'prepared_statement_name_func': lambda: f'__asyncpg_{uuid4()}__',
+        }
+    return options
+
+
+engine = create_async_engine(url=settings.db_dsn, echo=settings.db_echo, future=True, **engine_options())
 async_session = async_sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
 
+pool_events = {'connects': 0, 'checkouts': 0, 'invalidations': 0}
+
+
+@event.listens_for(engine.sync_engine, 'connect')
+def _on_connect(dbapi_connection, connection_record) -> None:
+    pool_events['connects'] += 1
+
+
+@event.listens_for(engine.sync_engine, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    pool_events['checkouts'] += 1
+
+
+@event.listens_for(engine.sync_engine, 'invalidate')
+def _on_invalidate(dbapi_connection, connection_record, exception) -> None:
+    pool_events['invalidations'] += 1
+
+
+def pool_stats() -> dict[str, Any]:
+    pool = engine.pool
+    checked_out = pool.checkedout()
+    capacity = settings.db_pool_size + max(settings.db_max_overflow, 0)
+    return {
+        'size': pool.size(),
+        'max_overflow': settings.db_max_overflow,
+        'checked_out': checked_out,
+        'checked_in': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+        'saturation': round(checked_out / capacity, 3) if capacity else None,
+        'pgbouncer': settings.db_pgbouncer,
+        **pool_events,
+    }
+
 
 async def get_session() -> AsyncSession:
+    """The session checks a connection out on first use only, so requests that never query hold none."""
     async with async_session() as session:
         yield session
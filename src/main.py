@@ -1,3 +1,7 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from typing import Any, Awaitable, Callable
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
@@ -5,19 +9,62 @@ from src.core.config import settings
 
 from src.api.v1 import base
 from src.core.logger import logger
+from src.db.db import async_session, pool_stats
+from src.services.base import quota_service, upload_service, user_service
+from src.utils.archive_cache import archive_cache
+from src.utils.executor import compression_executor
+from src.utils.metrics import MetricsMiddleware, register_cache_metrics, register_pool_gauges, watch_event_loop_lag
+from src.utils.tools import password_executor
+
+
+async def run_periodically(name: str, job: Callable[..., Awaitable[Any]], interval: float):
+    while True:
+        try:
+            async with async_session() as session:
+                await job(db=session)
+        except Exception as exc:
+            logger.error(f'{name} failed: {exc}')
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await archive_cache.sweep()
+    tasks = [
+        asyncio.create_task(run_periodically('Upload sessions cleanup', upload_service.cleanup_expired,
+                                             settings.upload_cleanup_interval_seconds)),
+        asyncio.create_task(run_periodically('Storage usage reconcile', quota_service.reconcile,
+                                             settings.usage_reconcile_interval_seconds)),
+    ]
+    if settings.metrics_enabled:
+        tasks.append(asyncio.create_task(watch_event_loop_lag(settings.loop_lag_interval_seconds)))
+    yield
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with suppress(asyncio.CancelledError):
+            await task
+    compression_executor.shutdown()
+    password_executor.shutdown(wait=False, cancel_futures=True)
+
 
 app = FastAPI(
     title=settings.project_name,
+    lifespan=lifespan,
     docs_url='/api/openapi',
     openapi_url='/api/openapi.json',
     default_response_class=ORJSONResponse,
 )
 app.include_router(base.api_router, prefix='/api/v1')
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+    register_pool_gauges(pool_stats)
+    register_cache_metrics('user_cache', user_service.cache.stats)
 
 if __name__ == '__main__':
     logger.info(f'Start server on http://{settings.project_host}:{settings.project_port}')
     uvicorn.run(
-        'main:app',
+        'src.main:app',
         host=settings.project_host,
         port=settings.project_port,
     )
\ No newline at end of file
@@ -1,8 +1,8 @@
 from datetime import datetime
 from uuid import uuid4
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, String, Integer
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Index, String, Integer
 from sqlalchemy.orm import relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from src.db.db import Base
 
 
@@ -13,6 +13,11 @@ class User(Base):
     password = Column(String(125), nullable=False)
     files = relationship('File', backref='user', cascade='all, delete')
     created_at = Column(DateTime, index=True, default=datetime.utcnow)
+    quota_bytes = Column(BigInteger, nullable=True)
+    used_bytes = Column(BigInteger, nullable=False, default=0)
+    files_count = Column(Integer, nullable=False, default=0)
+    files_version = Column(BigInteger, nullable=False, default=0)
+    files_changed_at = Column(DateTime, nullable=True)
 
 
 class File(Base):
@@ -21,6 +26,52 @@ class File(Base):
     user_id = Column(ForeignKey('users.id', ondelete='CASCADE'))
     name = Column(String(125), nullable=False)
     path = Column(String(255), nullable=False, unique=True)
-    size = Column(Integer, nullable=False)
+    parent = Column(String(255), nullable=False, default='')
+    size = Column(BigInteger, nullable=False)
+    digest = Column(ForeignKey('blobs.digest'), index=True, nullable=True)
     is_downloadable = Column(Boolean, default=False)
     created_at = Column(DateTime, index=True, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_files_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+        Index('ix_files_user_id_size_id', 'user_id', 'size', 'id'),
+        Index('ix_files_user_id_name_id', 'user_id', 'name', 'id'),
+        Index('ix_files_user_id_path', 'user_id', 'path', postgresql_ops={'path': 'varchar_pattern_ops'}),
+        Index('ix_files_user_id_parent', 'user_id', 'parent', postgresql_ops={'parent': 'varchar_pattern_ops'}),
+    )
+
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+    digest = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class BlobChunk(Base):
+    """Where the content-defined chunks of a blob start, from the manifest of its delta upload."""
+    __tablename__ = 'blob_chunks'
+    blob_digest = Column(ForeignKey('blobs.digest', ondelete='CASCADE'), primary_key=True)
+    offset = Column(BigInteger, primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    digest = Column(String(64), index=True, nullable=False)
+
+
+class UploadSession(Base):
+    __tablename__ = 'upload_sessions'
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    user_id = Column(ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    name = Column(String(125), nullable=False)
+    path = Column(String(255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    manifest = Column(JSONB, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True, nullable=False)
+
+
+class UploadChunk(Base):
+    __tablename__ = 'upload_chunks'
+    session_id = Column(ForeignKey('upload_sessions.id', ondelete='CASCADE'), primary_key=True)
+    offset = Column(BigInteger, primary_key=True)
+    size = Column(BigInteger, nullable=False)
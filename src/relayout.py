@@ -0,0 +1,159 @@
+"""Moves stored files into the sharded layout while the service keeps running.
+
+    python -m src.relayout legacy [--batch-size 500] [--grace-seconds 60]
+        Files saved at files_folder/<user path> before the blob store existed are hashed,
+        hard linked into blobs/ab/cd/<digest> and their rows switched to the digest.
+        The old copies are removed after a grace period for downloads already redirected to them.
+
+    python -m src.relayout blobs --from-depth 1 --from-width 2 [--cleanup]
+        Changing BLOBS_FANOUT_DEPTH/WIDTH: link every blob into the new layout, restart the service
+        with the new settings, then run again with --cleanup to drop the old paths. Blobs uploaded
+        between the link pass and the restart exist only at the old path, --cleanup links them first.
+"""
+import argparse
+import asyncio
+import errno
+import os
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from src.core import settings
+from src.core.logger import logger
+from src.db.db import async_session
+from src.models.models import Blob, File
+from src.services.blob import blob_store
+from src.utils.layout import StorageLayout
+from src.utils.tools import copy_fileobj_atomic, hash_path
+
+
+def link_into_place(source: str, target: str) -> bool:
+    """Blocking: hard links source to target, copying across devices; False when target already exists."""
+    if os.path.exists(target):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        return False
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        with open(source, 'rb') as fileobj:
+            copy_fileobj_atomic(fileobj, target, settings.upload_chunk_size)
+    return True
+
+
+def remove_file(full_file_path: str, stop_at: str) -> None:
+    """Blocking: removes a file and then its directories while they are empty, up to stop_at."""
+    try:
+        os.unlink(full_file_path)
+    except FileNotFoundError:
+        return
+    directory = os.path.dirname(full_file_path)
+    while directory != stop_at and directory.startswith(stop_at):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+async def migrate_legacy_batch(db: AsyncSession, after: Optional[UUID],
+                               batch_size: int) -> tuple[list[str], Optional[UUID]]:
+    """Moves one batch of legacy rows into the blob store; returns their old paths and the last row id."""
+    statement = select(File.id, File.path, File.size).where(File.digest.is_(None)).order_by(File.id)
+    if after is not None:
+        statement = statement.where(File.id > after)
+    rows = (await db.execute(statement.limit(batch_size))).all()
+    moved, orphaned = [], []
+    for row in rows:
+        full_file_path = os.path.join(settings.files_folder, row.path)
+        if not os.path.isfile(full_file_path):
+            logger.warning(f'Legacy file {row.path} is missing on disk, skip')
+            continue
+        digest, size = await run_in_threadpool(hash_path, full_file_path, settings.upload_chunk_size)
+        # linked under the reference, so a concurrent discard of the digest cannot remove it again
+        await blob_store.acquire(db=db, digest=digest, size=size)
+        await run_in_threadpool(link_into_place, full_file_path, blob_store.path(digest))
+        # the row may have been overwritten meanwhile, then it already points to a blob
+        statement = (update(File).where(File.id == row.id, File.digest.is_(None), File.size == size)
+                     .values(digest=digest).returning(File.id))
+        if (await db.execute(statement)).scalar_one_or_none() is None:
+            if await blob_store.release(db=db, digest=digest):
+                orphaned.append(digest)
+            continue
+        moved.append(full_file_path)
+    await db.commit()
+    for digest in orphaned:
+        await blob_store.discard(digest)
+    return moved, rows[-1].id if rows else None
+
+
+async def migrate_legacy(db: AsyncSession, batch_size: int, grace_seconds: float) -> int:
+    moved_total = 0
+    after = None
+    while True:
+        moved, after = await migrate_legacy_batch(db, after, batch_size)
+        if moved:
+            logger.info(f'Moved {len(moved)} legacy files into the blob store')
+            # downloads redirected before the commit may still read the old paths
+            await asyncio.sleep(grace_seconds)
+            for full_file_path in moved:
+                await run_in_threadpool(remove_file, full_file_path, settings.files_folder)
+            moved_total += len(moved)
+        if after is None:
+            return moved_total
+
+
+async def relayout_blobs(db: AsyncSession, previous: StorageLayout, cleanup: bool, batch_size: int) -> int:
+    """Links every blob from the previous layout into the current one, or removes the previous paths."""
+    changed = 0
+    after = ''
+    while True:
+        statement = select(Blob.digest).where(Blob.digest > after).order_by(Blob.digest).limit(batch_size)
+        digests = (await db.execute(statement)).scalars().all()
+        await db.commit()
+        if not digests:
+            return changed
+        for digest in digests:
+            old_path = os.path.join(blob_store.root, blob_store.relative_path(digest, previous))
+            new_path = blob_store.path(digest)
+            if cleanup:
+                if os.path.exists(old_path):
+                    await run_in_threadpool(link_into_place, old_path, new_path)
+                    await run_in_threadpool(remove_file, old_path, os.path.join(blob_store.root,
+                                                                                blob_store.folder_name))
+                    changed += 1
+            elif os.path.exists(old_path) and await run_in_threadpool(link_into_place, old_path, new_path):
+                changed += 1
+        after = digests[-1]
+
+
+async def main(args: argparse.Namespace) -> None:
+    async with async_session() as db:
+        if args.command == 'legacy':
+            count = await migrate_legacy(db, args.batch_size, args.grace_seconds)
+        else:
+            previous = StorageLayout(args.from_depth, args.from_width)
+            if previous == blob_store.layout:
+                raise SystemExit(f'Blobs already use {previous}')
+            count = await relayout_blobs(db, previous, args.cleanup, args.batch_size)
+    logger.info(f'Relayout {args.command} done, {count} files changed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    legacy = subparsers.add_parser('legacy', help='Move files stored by user path into the blob store')
+    legacy.add_argument('--grace-seconds', type=float, default=60.0)
+    blobs = subparsers.add_parser('blobs', help='Move blobs from a previous fan-out layout to the current one')
+    blobs.add_argument('--from-depth', type=int, required=True)
+    blobs.add_argument('--from-width', type=int, required=True)
+    blobs.add_argument('--cleanup', action='store_true', help='Remove paths of the previous layout')
+    for subparser in (legacy, blobs):
+        subparser.add_argument('--batch-size', type=int, default=500)
+    asyncio.run(main(parser.parse_args()))
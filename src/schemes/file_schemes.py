@@ -1,5 +1,5 @@
 from datetime import datetime as dt
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 from pydantic import BaseModel, validator
 
@@ -10,6 +10,7 @@ class FileBase(BaseModel):
     created_at: dt
     path: str
     size: int
+    digest: Optional[str] = None
     is_downloadable: bool
 
     class Config:
@@ -37,13 +38,49 @@ class File(FileBase):
 
 
 class FilesList(BaseModel):
+    """Documents GET /files/, whose body is written by services.file.encode_files_page."""
     account_id: UUID
-    files: List
+    files: List[File]
+    next_cursor: Optional[str] = None
 
     class Config:
         orm_mode = True
 
 
+class DirectoryEntry(BaseModel):
+    name: str
+    is_dir: bool
+    files_count: int
+    size: int
+
+
+class DirectoryInfo(BaseModel):
+    path: str
+    files_count: int
+    size: int
+    entries: List[DirectoryEntry]
+
+
+class BatchItem(BaseModel):
+    path: str
+    status: int
+    detail: Optional[str] = None
+    file: Optional[File] = None
+
+
+class BatchResult(BaseModel):
+    created: int
+    updated: int
+    failed: int
+    items: List[BatchItem]
+
+
+class StorageUsage(BaseModel):
+    used_bytes: int
+    files_count: int
+    quota_bytes: Optional[int] = None
+
+
 class ObjPath(BaseModel):
     path: str
 
@@ -0,0 +1,44 @@
+from datetime import datetime as dt
+from typing import List
+from uuid import UUID
+from pydantic import BaseModel, constr
+
+
+class UploadSessionCreate(BaseModel):
+    path: str
+    size: int
+
+
+class UploadSession(BaseModel):
+    id: UUID
+    name: str
+    path: str
+    size: int
+    expires_at: dt
+    received: List[List[int]] = []
+
+    class Config:
+        orm_mode = True
+
+
+Digest = constr(regex=r'^[0-9a-f]{64}$')
+
+
+class DeltaChunk(BaseModel):
+    digest: Digest
+    size: int
+
+
+class DeltaUploadCreate(BaseModel):
+    path: str
+    chunks: List[DeltaChunk]
+
+
+class MissingChunk(BaseModel):
+    offset: int
+    size: int
+    digest: str
+
+
+class DeltaUploadSession(UploadSession):
+    missing: List[MissingChunk] = []
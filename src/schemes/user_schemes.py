@@ -26,6 +26,7 @@ class CurrentUser(User):
     def datetime_to_str(cls, value):
         if isinstance(value, str):
             return dt.fromisoformat(value)
+        return value
 
 class Token(BaseModel):
     access_token: str
@@ -1,7 +1,10 @@
 from src.services.user import RepositoryUserDB
 from src.services.file import RepositoryFileDB
+from src.services.upload import RepositoryUploadDB
+from src.services.quota import RepositoryQuotaDB
 from src.models.models import User as UserModel
 from src.models.models import File as FileModel
+from src.models.models import UploadSession as UploadSessionModel
 from src.schemes.user_schemes import UserRegister
 
 
@@ -11,5 +14,13 @@ class RepositoryUser(RepositoryUserDB[UserModel, UserRegister]):
 class RepositoryFile(RepositoryFileDB[UserModel]):
     pass
 
+class RepositoryUpload(RepositoryUploadDB[UploadSessionModel]):
+    pass
+
+class RepositoryQuota(RepositoryQuotaDB[UserModel]):
+    pass
+
 user_service = RepositoryUser(UserModel)
-file_service = RepositoryFile(FileModel)
+quota_service = RepositoryQuota(UserModel)
+file_service = RepositoryFile(FileModel, quota=quota_service)
+upload_service = RepositoryUpload(UploadSessionModel, quota=quota_service)
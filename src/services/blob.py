@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from typing import AsyncIterable, BinaryIO, Iterable, Optional
+
+from fastapi import File as FileObj
+from sqlalchemy import delete, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from src.core import settings
+from src.core.logger import logger
+from src.db.db import async_session
+from src.models.models import Blob, BlobChunk
+from src.utils.cdc import chunk_manifest
+from src.utils.layout import StorageLayout
+from src.utils.tools import FILE_MODE, copy_fileobj_atomic, copy_fileobj_hashed, hash_fileobj, write_hashed
+
+
+class BlobStore:
+    """Stores every distinct upload once on disk, addressed by its sha256 digest.
+
+    A blob file is put in place only after acquire() and removed only by discard(): acquire() holds a
+    shared advisory lock on the digest until the caller commits, discard() takes it exclusively and
+    unlinks only when no row references the blob, so a file is never removed under a new reference.
+    """
+
+    def __init__(self, root: str, folder_name: str, layout: StorageLayout):
+        self.root = root
+        self.folder_name = folder_name
+        self.layout = layout
+
+    def relative_path(self, digest: str, layout: Optional[StorageLayout] = None) -> str:
+        return os.path.join(self.folder_name, (layout or self.layout).relative_path(digest))
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, self.relative_path(digest))
+
+    async def hash_upload(self, file_obj: FileObj) -> tuple[str, int]:
+        return await run_in_threadpool(hash_fileobj, file_obj.file, settings.upload_chunk_size)
+
+    async def write_upload(self, file_obj: FileObj, digest: str) -> None:
+        """Writes the blob file from an upload unless it is on disk; call after acquire()."""
+        if not await run_in_threadpool(os.path.exists, self.path(digest)):
+            await run_in_threadpool(copy_fileobj_atomic, file_obj.file, self.path(digest),
+                                    settings.upload_chunk_size)
+
+    async def ingest(self, chunks: AsyncIterable[bytes]) -> tuple[str, str, int]:
+        """Writes a stream into a temp file of the store in one pass, hashing and counting it on the way.
+
+        Chunks are gathered into upload_chunk_size buffers; a writer task hashes and writes them in a
+        thread while the next ones are received, at most upload_queue_depth buffers wait in between.
+        Returns (tmp_path, digest, size); adopt() the temp file after acquire(), drop() it on failure.
+        """
+        directory = os.path.join(self.root, self.folder_name)
+        await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        dest = os.fdopen(fd, 'wb')
+        digest = hashlib.sha256()
+        size = 0
+        buffers: asyncio.Queue = asyncio.Queue(maxsize=settings.upload_queue_depth)
+
+        async def write() -> None:
+            while (buffer := await buffers.get()) is not None:
+                await run_in_threadpool(write_hashed, dest, digest, buffer)
+
+        async def put(buffer: Optional[bytes]) -> None:
+            putting = asyncio.ensure_future(buffers.put(buffer))
+            await asyncio.wait((putting, writing), return_when=asyncio.FIRST_COMPLETED)
+            if not putting.done():
+                # the writer failed while the queue was full
+                putting.cancel()
+                writing.result()
+
+        writing = asyncio.ensure_future(write())
+        try:
+            pending = bytearray()
+            async for chunk in chunks:
+                size += len(chunk)
+                pending += chunk
+                if len(pending) >= settings.upload_chunk_size:
+                    await put(bytes(pending))
+                    pending.clear()
+            if pending:
+                await put(bytes(pending))
+            await put(None)
+            await writing
+            await run_in_threadpool(dest.close)
+        except BaseException:
+            writing.cancel()
+            # a write already running in a thread finishes before the file is closed
+            await asyncio.gather(writing, return_exceptions=True)
+            await run_in_threadpool(dest.close)
+            os.unlink(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest(), size
+
+    async def adopt(self, full_file_path: str, digest: str) -> None:
+        """Moves an already written file into the store without copying it; call after acquire()."""
+        await run_in_threadpool(self._adopt, full_file_path, digest)
+
+    async def drop(self, *full_file_paths: str) -> None:
+        """Removes temp files that were not adopted, already adopted ones are skipped."""
+        await run_in_threadpool(self._drop, full_file_paths)
+
+    @staticmethod
+    def _drop(full_file_paths: Iterable[str]) -> None:
+        for full_file_path in full_file_paths:
+            try:
+                os.unlink(full_file_path)
+            except FileNotFoundError:
+                pass
+
+    def _adopt(self, full_file_path: str, digest: str) -> None:
+        target = self.path(digest)
+        if os.path.exists(target):
+            os.unlink(full_file_path)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd = os.open(full_file_path, os.O_RDONLY)
+        try:
+            os.fchmod(fd, FILE_MODE)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(full_file_path, target)
+
+    def stage_fileobj(self, fileobj: BinaryIO) -> tuple[str, str, int]:
+        """Blocking: writes and hashes fileobj into a temp file of the store, returns (tmp_path, digest, size)."""
+        return copy_fileobj_hashed(fileobj, os.path.join(self.root, self.folder_name), settings.upload_chunk_size)
+
+    async def _lock(self, db: AsyncSession, digests: Iterable[str], exclusive: bool = False) -> None:
+        """Takes the transaction scoped advisory locks of the digests, in sorted order."""
+        function = 'pg_advisory_xact_lock' if exclusive else 'pg_advisory_xact_lock_shared'
+        statement = text(f'SELECT {function}(hashtextextended(digest, 0)) '
+                         f'FROM unnest(CAST(:digests AS text[])) AS digest')
+        await db.execute(statement, {'digests': sorted(digests)})
+
+    async def acquire_many(self, db: AsyncSession, references: dict[str, tuple[int, int]]) -> None:
+        """Adds count references per digest from {digest: (size, count)} in one batch; caller commits."""
+        if not references:
+            return
+        await self._lock(db, references)
+        statement = insert(Blob)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Blob.digest],
+            set_={'ref_count': Blob.ref_count + statement.excluded.ref_count},
+        )
+        await db.execute(statement, [{'digest': digest, 'size': size, 'ref_count': count}
+                                     for digest, (size, count) in references.items()])
+
+    async def release_many(self, db: AsyncSession, references: dict[str, tuple[int, int]]) -> list[str]:
+        """Drops count references per digest, returns digests that became unreferenced (see release())."""
+        if not references:
+            return []
+        await self.acquire_many(db, {digest: (size, -count) for digest, (size, count) in references.items()})
+        statement = (delete(Blob).where(Blob.digest.in_(list(references)), Blob.ref_count <= 0)
+                     .returning(Blob.digest))
+        return list((await db.execute(statement)).scalars().all())
+
+    async def acquire(self, db: AsyncSession, digest: str, size: int) -> None:
+        """Adds a reference to the blob, creating its row on first use; caller commits."""
+        await self._lock(db, [digest])
+        statement = insert(Blob).values(digest=digest, size=size, ref_count=1)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Blob.digest],
+            set_={'ref_count': Blob.ref_count + 1},
+        )
+        await db.execute(statement)
+
+    async def release(self, db: AsyncSession, digest: Optional[str]) -> bool:
+        """Drops a reference to the blob, returns True when the blob became unreferenced.
+
+        The row is deleted in the caller's transaction; call discard() after commit to free the disk.
+        """
+        if digest is None:
+            return False
+        statement = (update(Blob).where(Blob.digest == digest)
+                     .values(ref_count=Blob.ref_count - 1).returning(Blob.ref_count))
+        ref_count = (await db.execute(statement)).scalar_one_or_none()
+        if ref_count is None or ref_count > 0:
+            return False
+        await db.execute(delete(Blob).where(Blob.digest == digest, Blob.ref_count <= 0))
+        return True
+
+    async def index_chunks(self, db: AsyncSession, digest: str, manifest: list) -> None:
+        """Records the [digest, size] chunks of a blob so later delta uploads can reuse them; commits."""
+        if await self._is_indexed(db, digest):
+            return
+        rows = []
+        offset = 0
+        for chunk_digest, size in manifest:
+            rows.append({'blob_digest': digest, 'offset': offset, 'size': size, 'digest': chunk_digest})
+            offset += size
+        await db.execute(insert(BlobChunk).on_conflict_do_nothing(), rows)
+        await db.commit()
+
+    async def index_blob(self, db: AsyncSession, digest: str) -> None:
+        """Chunks a blob stored by a plain upload with the delta_chunk_* sizes and indexes it; commits."""
+        if await self._is_indexed(db, digest):
+            return
+        try:
+            manifest = await run_in_threadpool(self._chunk_blob, digest)
+        except FileNotFoundError:
+            logger.error(f'Blob {digest} is missing on disk, can not index its chunks')
+            return
+        await self.index_chunks(db, digest, manifest)
+
+    @staticmethod
+    async def _is_indexed(db: AsyncSession, digest: str) -> bool:
+        statement = select(BlobChunk.offset).where(BlobChunk.blob_digest == digest).limit(1)
+        return await db.scalar(statement) is not None
+
+    def _chunk_blob(self, digest: str) -> list:
+        with open(self.path(digest), 'rb') as fileobj:
+            return [[chunk['digest'], chunk['size']] for chunk in chunk_manifest(
+                fileobj, settings.delta_chunk_min_size, settings.delta_chunk_avg_size, settings.delta_chunk_max_size)]
+
+    async def discard(self, digest: str) -> None:
+        """Removes the blob file after the commit that dropped its row, unless it got referenced again."""
+        async with async_session() as db:
+            await self._lock(db, [digest], exclusive=True)
+            if await db.scalar(select(Blob.digest).where(Blob.digest == digest)) is None:
+                await run_in_threadpool(self._unlink, digest)
+            await db.commit()
+
+    def _unlink(self, digest: str) -> None:
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            logger.error(f'Blob {digest} is already missing on disk')
+
+
+blob_store = BlobStore(settings.files_folder, settings.blobs_folder_name,
+                       StorageLayout(settings.blobs_fanout_depth, settings.blobs_fanout_width))
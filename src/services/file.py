@@ -1,17 +1,32 @@
 from abc import ABC
+import asyncio
+import base64
+import json
 import os
-from pathlib import Path
-from typing import Any, Generic, Optional, Type, TypeVar
+import tarfile
+from datetime import datetime, timezone
+from uuid import UUID, uuid4
+from typing import Any, AsyncIterator, BinaryIO, Generic, Iterable, Optional, Type, TypeVar
+
+import orjson
 from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import File as FileObj
-from sqlalchemy import select
+from sqlalchemy import String, and_, any_, bindparam, func, or_, select, tuple_
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 
-from src.db.db import Base
+from src.db.db import Base, async_session
 from src.core import settings
 from src.schemes import file_schemes
-from src.utils.tools import write_file, archive_file
+from src.utils.archive_cache import archive_cache
+from src.utils.executor import compression_executor
+from src.utils.multipart import MultipartFileStream
+from src.utils.responses import utc_timestamp
+from src.services.blob import blob_store
+from src.services.quota import RepositoryQuotaDB
+from src.utils.tools import build_archive, archive_name, ARCHIVERS
 from src.core.logger import logger
 
 
@@ -19,9 +34,18 @@ class Repository(ABC):
     def create_file(self, *args, **kwargs):
         raise NotImplementedError
 
+    def create_files_batch(self, *args, **kwargs):
+        raise NotImplementedError
+
     def get_list_files(self, *args, **kwargs):
         raise NotImplementedError
 
+    def export_files(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def delete_file(self, *args, **kwargs):
+        raise NotImplementedError
+
     def get_file_by_path(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -34,55 +58,416 @@ class Repository(ABC):
 
 ModelType = TypeVar("ModelType", bound=Base)
 
+SORT_FIELDS = ('created_at', 'size', 'name')
+UPSERT_ATTEMPTS = 3
+
+
+def normalize_directory(path: str) -> str:
+    directory = os.path.normpath(path.lstrip('/\\'))
+    return '' if directory == '.' else directory
+
+
+def batch_item_path(directory: str, name: str) -> Optional[str]:
+    """Joins a client supplied relative name to directory, None when it escapes it or is not a file."""
+    name = name.replace('\\', '/')
+    if not name or name.startswith('/'):
+        return None
+    path = os.path.normpath(os.path.join(directory, name))
+    if path in ('', '.', '..') or path.startswith('../') or (directory and not path.startswith(directory + '/')):
+        return None
+    return path
+
+
+def _unpack_tar(fileobj: BinaryIO, directory: str, max_files: int) -> list[dict]:
+    """Blocking: writes every regular file of a tar stream to a blob store temp file, returns the batch items."""
+    items = []
+    try:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                path = batch_item_path(directory, member.name)
+                if path is None:
+                    items.append({'path': member.name, 'status': status.HTTP_400_BAD_REQUEST,
+                                  'detail': 'Invalid path.'})
+                    continue
+                if len(items) >= max_files:
+                    items.append({'path': path, 'status': status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                  'detail': 'Too many files in one batch.'})
+                    break
+                source, digest, size = blob_store.stage_fileobj(tar.extractfile(member))
+                items.append({'path': path, 'digest': digest, 'size': size, 'source': source})
+    except tarfile.TarError as error:
+        items.append({'path': '', 'status': status.HTTP_400_BAD_REQUEST, 'detail': f'Broken tar stream: {error}'})
+    return items
+
+
+# the columns of file_schemes.File in its field order, so the fast path and the OpenAPI schema agree
+LIST_COLUMNS = tuple(file_schemes.File.__fields__)
+
+
+def encode_files_page(account_id: UUID, rows: Iterable[tuple], next_cursor: Optional[str]) -> bytes:
+    """Serializes a listing page from LIST_COLUMNS tuples straight to FilesList JSON.
+
+    No ORM objects and no per row models: orjson writes the UUIDs and datetimes itself.
+    """
+    # asyncpg returns its own UUID class, which orjson hands to default
+    return orjson.dumps({'account_id': account_id, 'files': [dict(zip(LIST_COLUMNS, row)) for row in rows],
+                         'next_cursor': next_cursor}, default=str)
+
+
+def encode_cursor(value: Any, last_id: UUID) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, str(last_id)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple[Any, UUID]:
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if sort == 'created_at':
+            value = datetime.fromisoformat(value)
+        elif sort == 'size':
+            value = int(value)
+        else:
+            value = str(value)
+        return value, UUID(last_id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Invalid cursor.'
+        )
+
 
 class RepositoryFileDB(Repository, Generic[ModelType]):
-    def __init__(self, model: Type[ModelType]):
+    def __init__(self, model: Type[ModelType], quota: RepositoryQuotaDB):
         self._model = model
+        self._quota = quota
 
-    async def create_file(self, db: AsyncSession, user_obj: ModelType, file_obj: FileObj, file_path: str) -> Optional[
-        ModelType]:
+    async def create_file(self, db: AsyncSession, user_obj: ModelType, file_obj: MultipartFileStream,
+                          file_path: str) -> Optional[ModelType]:
+        source, digest, size = await blob_store.ingest(file_obj)
         if file_path.split('/')[-1] == file_obj.filename:
-            full_path_to_file = os.path.join(settings.files_folder, file_path)
             path_to_db = os.path.normpath(file_path)
         else:
-            full_path_to_file = os.path.join(settings.files_folder, file_path, file_obj.filename)
             path_to_db = os.path.join(os.path.normpath(file_path), file_obj.filename)
-        path = Path(os.path.abspath(full_path_to_file))
         try:
-            path.parent.absolute().mkdir(parents=True, exist_ok=True)
-        except FileExistsError:
+            return await self.add_file_record(db=db, user_obj=user_obj, path=path_to_db, name=file_obj.filename,
+                                              digest=digest, size=size, source=source)
+        finally:
+            await blob_store.drop(source)
+
+    def _upsert(self) -> Any:
+        """INSERT ... ON CONFLICT (path) DO UPDATE of a row the caller locked, see _upsert_rows()."""
+        statement = insert(self._model)
+        statement = statement.on_conflict_do_update(
+            index_elements=[self._model.path],
+            set_={'size': statement.excluded.size, 'digest': statement.excluded.digest,
+                  'created_at': statement.excluded.created_at},
+            where=and_(self._model.user_id == statement.excluded.user_id, self._model.id == statement.excluded.id),
+        )
+        return statement.returning(self._model).execution_options(populate_existing=True)
+
+    async def _lock_paths(self, db: AsyncSession, paths: list[str]) -> dict[str, Any]:
+        statement = (select(self._model.id, self._model.user_id, self._model.path, self._model.digest,
+                            self._model.size)
+                     .where(self._model.path == any_(bindparam('paths', type_=ARRAY(String))))
+                     .order_by(self._model.path)
+                     .with_for_update())
+        return {row.path: row for row in await db.execute(statement, {'paths': paths})}
+
+    async def _upsert_rows(self, db: AsyncSession, user_obj: ModelType,
+                           rows: list[dict]) -> dict[str, tuple[ModelType, Optional[str], Optional[int]]]:
+        """Creates or overwrites the caller's rows, returns {path: (file, old digest, old size)} of the stored ones.
+
+        Existing rows are locked with SELECT ... FOR UPDATE first, so the old digest and size are those of
+        the row actually replaced even when the same path is overwritten concurrently. The upsert keeps
+        their id and only updates a row whose id matches, so a row someone inserted after the lock is left
+        alone and its path is locked and tried again. Paths of other users are never stored.
+        """
+        stored = {}
+        pending = {row['path']: row for row in rows}
+        for _ in range(UPSERT_ATTEMPTS):
+            existing = await self._lock_paths(db, sorted(pending))
+            batch = []
+            for path, row in pending.items():
+                current = existing.get(path)
+                if current is None:
+                    batch.append({**row, 'id': uuid4()})
+                elif current.user_id == user_obj.id:
+                    batch.append({**row, 'id': current.id})
+            if not batch:
+                break
+            for file in (await db.execute(self._upsert(), batch)).scalars():
+                current = existing.get(file.path)
+                stored[file.path] = (file, current and current.digest, current and current.size)
+            pending = {row['path']: row for row in batch if row['path'] not in stored}
+            if not pending:
+                break
+        return stored
+
+    def _row(self, user_obj: ModelType, path: str, digest: str, size: int, now: datetime) -> dict:
+        return {'id': uuid4(), 'user_id': user_obj.id, 'name': os.path.basename(path), 'path': path,
+                'parent': os.path.dirname(path), 'size': size, 'digest': digest, 'is_downloadable': True,
+                'created_at': now}
+
+    @staticmethod
+    async def _commit_placed(db: AsyncSession, digests: Iterable[str]) -> None:
+        """Commits a transaction that put blob files in place; when it fails, unreferenced ones are discarded."""
+        try:
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            for digest in digests:
+                await blob_store.discard(digest)
+            raise
+
+    async def add_file_record(self, db: AsyncSession, user_obj: ModelType, path: str, name: str, digest: str,
+                              size: int, source: str) -> ModelType:
+        """Creates or overwrites the File row for the blob written to source and moves the reference to it.
+
+        source is adopted into the store right before the commit; on failure it is left to the caller.
+        """
+        await blob_store.acquire(db=db, digest=digest, size=size)
+        row = self._row(user_obj, path, digest, size, datetime.utcnow())
+        stored = await self._upsert_rows(db, user_obj, [row])
+        if path not in stored:
+            await db.rollback()
             raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail='File with this name already exists'
+                status_code=status.HTTP_409_CONFLICT,
+                detail='File already exists.'
             )
-        await write_file(file_obj=file_obj, full_file_path=full_path_to_file)
-        size = os.path.getsize(full_path_to_file)
-        new_file = self._model(name=file_obj.filename, path=path_to_db, size=size, is_downloadable=True, user=user_obj)
-        db.add(new_file)
-        await db.commit()
-        await db.refresh(new_file)
+        new_file, old_digest, old_size = stored[path]
+        await self._quota.charge(db=db, user_id=user_obj.id, size_delta=size - (old_size or 0),
+                                 count_delta=int(old_size is None))
+        orphaned = old_digest is not None and await blob_store.release(db=db, digest=old_digest)
+        await blob_store.adopt(full_file_path=source, digest=digest)
+        await self._commit_placed(db, [digest])
+        if orphaned:
+            await blob_store.discard(old_digest)
+        if old_size is not None:
+            logger.info(f'Overwrite file {path}')
         return new_file
 
-    async def get_list_files(self, db: AsyncSession, user_obj: ModelType) -> list[ModelType]:
-        statement = select(self._model).where(self._model.user_id == user_obj.id)
-        files = await db.execute(statement=statement)
-        results = files.scalars().all()
-        return [file_schemes.File.from_orm(file).dict() for file in results]
+    async def create_files_batch(self, db: AsyncSession, user_obj: ModelType, directory: str,
+                                 files: list[FileObj], archive: Optional[FileObj] = None) -> list[dict]:
+        """Stores many files with bounded parallelism and creates their rows with one INSERT and one COMMIT.
+
+        Returns a result per item: 201 created, 200 overwritten, or an error status with detail.
+        """
+        directory = normalize_directory(directory)
+        if len(files) > settings.batch_upload_max_files:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f'At most {settings.batch_upload_max_files} files can be uploaded at once.'
+            )
+        slots = asyncio.Semaphore(settings.batch_upload_parallelism)
+
+        async def hash_part(file_obj: FileObj) -> tuple[str, int]:
+            async with slots:
+                return await blob_store.hash_upload(file_obj)
+
+        items = []
+        parts = []
+        for file_obj in files:
+            path = batch_item_path(directory, file_obj.filename or '')
+            if path is None:
+                items.append({'path': file_obj.filename or '', 'status': status.HTTP_400_BAD_REQUEST,
+                              'detail': 'Invalid path.'})
+            else:
+                parts.append((file_obj, path))
+        hashes = await asyncio.gather(*(hash_part(file_obj) for file_obj, _ in parts))
+        for (file_obj, path), (digest, size) in zip(parts, hashes):
+            items.append({'path': path, 'digest': digest, 'size': size, 'upload': file_obj})
+        try:
+            if archive is not None:
+                items += await run_in_threadpool(_unpack_tar, archive.file, directory,
+                                                 settings.batch_upload_max_files - len(parts))
+            return await self._add_file_records(db=db, user_obj=user_obj, items=items)
+        finally:
+            await blob_store.drop(*(item['source'] for item in items if 'source' in item))
+
+    @staticmethod
+    async def _place_blobs(items: list[dict], skip: Iterable[str]) -> None:
+        """Puts the blob file of every referenced digest in place, from a staged temp file or the upload."""
+        slots = asyncio.Semaphore(settings.batch_upload_parallelism)
+        sources = {}
+        for item in items:
+            if 'digest' in item and item['digest'] not in skip:
+                sources.setdefault(item['digest'], item)
 
-    async def get_file_by_path(self, db: AsyncSession, path: str) -> ModelType | None:
+        async def place(item: dict) -> None:
+            async with slots:
+                if 'source' in item:
+                    await blob_store.adopt(full_file_path=item['source'], digest=item['digest'])
+                else:
+                    await blob_store.write_upload(file_obj=item['upload'], digest=item['digest'])
+
+        await asyncio.gather(*(place(item) for item in sources.values()))
+
+    @staticmethod
+    def _add_reference(references: dict[str, tuple[int, int]], digest: str, size: int) -> None:
+        size, count = references.get(digest, (size, 0))
+        references[digest] = size, count + 1
+
+    def _batch_rows(self, user_obj: ModelType, items: list[dict]) -> tuple[dict[str, tuple[int, int]], list[dict]]:
+        """Marks paths repeated in the batch as 409, returns the blob references and the rows to store."""
+        seen = set()
+        references: dict[str, tuple[int, int]] = {}
+        rows = []
+        now = datetime.utcnow()
+        for item in items:
+            if 'digest' not in item:
+                continue
+            self._add_reference(references, item['digest'], item['size'])
+            if item['path'] in seen:
+                item.update(status=status.HTTP_409_CONFLICT, detail='Path is repeated in the batch.')
+                continue
+            seen.add(item['path'])
+            rows.append(self._row(user_obj, item['path'], item['digest'], item['size'], now))
+        return references, rows
+
+    def _batch_results(self, items: list[dict],
+                       stored: dict[str, tuple[ModelType, Optional[str], Optional[int]]]
+                       ) -> tuple[list[dict], dict[str, tuple[int, int]]]:
+        """Returns a result per item and the blob references to give back.
+
+        Every item that did not become a row, and every overwritten row, gives its reference back.
+        """
+        unused: dict[str, tuple[int, int]] = {}
+        for file, old_digest, _ in stored.values():
+            if old_digest is not None:
+                self._add_reference(unused, old_digest, 0)
+        results = []
+        for item in items:
+            if 'digest' in item:
+                if 'status' not in item and item['path'] in stored:
+                    file, _, old_size = stored[item['path']]
+                    item.update(status=status.HTTP_201_CREATED if old_size is None else status.HTTP_200_OK,
+                                file=file_schemes.File.from_orm(file))
+                else:
+                    item.setdefault('status', status.HTTP_409_CONFLICT)
+                    item.setdefault('detail', 'File already exists.')
+                    self._add_reference(unused, item['digest'], item['size'])
+            results.append({key: item.get(key) for key in ('path', 'status', 'detail', 'file')})
+        return results, unused
+
+    async def _add_file_records(self, db: AsyncSession, user_obj: ModelType, items: list[dict]) -> list[dict]:
+        references, rows = self._batch_rows(user_obj, items)
+        stored = {}
+        if rows:
+            await blob_store.acquire_many(db, references)
+            stored = await self._upsert_rows(db, user_obj, rows)
+        if stored:
+            await self._quota.charge(
+                db=db, user_id=user_obj.id,
+                size_delta=sum(file.size - (old_size or 0) for file, _, old_size in stored.values()),
+                count_delta=sum(old_size is None for _, _, old_size in stored.values()))
+        results, unused = self._batch_results(items, stored)
+        orphaned = await blob_store.release_many(db, unused)
+        await self._place_blobs(items, skip=orphaned)
+        await self._commit_placed(db, references.keys() - set(orphaned))
+        for digest in orphaned:
+            await blob_store.discard(digest)
+        logger.info(f'Batch upload of {len(items)} items for {user_obj.id}, {len(stored)} stored')
+        return results
+
+    async def delete_file(self, db: AsyncSession, user_obj: ModelType, path: str) -> None:
+        file_obj = await self.get_file_by_path(db=db, user_obj=user_obj, path=path)
+        if not file_obj:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Directory or file not found'
+            )
+        await db.delete(file_obj)
+        await db.flush()
+        await self._quota.charge(db=db, user_id=user_obj.id, size_delta=-file_obj.size, count_delta=-1)
+        orphaned = await blob_store.release(db=db, digest=file_obj.digest)
+        await db.commit()
+        if orphaned:
+            await blob_store.discard(file_obj.digest)
+        logger.info(f'Delete file {file_obj.path}')
+
+    async def get_list_files(self, db: AsyncSession, user_obj: ModelType, limit: int, sort: str = 'created_at',
+                             order: str = 'asc', prefix: Optional[str] = None,
+                             cursor: Optional[str] = None) -> tuple[list[tuple], Optional[str]]:
+        """Returns one page of files as LIST_COLUMNS tuples ordered by (sort, id) and the cursor of the next page.
+
+        Keyset pagination keeps every page an index range scan on (user_id, sort, id).
+        """
+        if sort not in SORT_FIELDS or order not in ('asc', 'desc'):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Sort must be one of {", ".join(SORT_FIELDS)} and order asc or desc.'
+            )
+        sort_column = getattr(self._model, sort)
+        columns = [getattr(self._model, column) for column in LIST_COLUMNS]
+        statement = select(*columns).where(self._model.user_id == user_obj.id)
+        prefix = os.path.normpath(prefix.lstrip('/\\')) if prefix else '.'
+        if prefix != '.':
+            # the file itself or anything below the directory, not siblings like prefix2/
+            statement = statement.where(or_(self._model.path == prefix,
+                                            self._model.path.startswith(prefix + '/', autoescape=True)))
+        if cursor:
+            value, last_id = decode_cursor(cursor, sort)
+            key, last_key = tuple_(sort_column, self._model.id), tuple_(value, last_id)
+            statement = statement.where(key > last_key if order == 'asc' else key < last_key)
+        if order == 'asc':
+            statement = statement.order_by(sort_column.asc(), self._model.id.asc())
+        else:
+            statement = statement.order_by(sort_column.desc(), self._model.id.desc())
+        files = await db.execute(statement=statement.limit(limit + 1))
+        results = files.all()
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor(getattr(results[-1], sort), results[-1].id)
+        return results, next_cursor
+
+    async def export_files(self, user_obj: ModelType, since: Optional[datetime] = None) -> AsyncIterator[bytes]:
+        """Yields every file of the user as NDJSON lines in (created_at, id) order, one chunk per batch.
+
+        Rows come through a server side cursor in a session of their own that lives as long as the
+        stream, so memory stays flat at any inventory size. since keeps files written after it.
+        """
+        statement = (select(*[getattr(self._model, column) for column in LIST_COLUMNS])
+                     .where(self._model.user_id == user_obj.id)
+                     .order_by(self._model.created_at, self._model.id))
+        if since is not None:
+            if since.tzinfo is not None:
+                since = since.astimezone(timezone.utc).replace(tzinfo=None)
+            statement = statement.where(self._model.created_at > since)
+        exported = 0
+        async with async_session() as db:
+            result = await db.stream(statement.execution_options(yield_per=settings.export_batch_rows))
+            async for rows in result.partitions():
+                exported += len(rows)
+                yield b''.join(orjson.dumps(dict(zip(LIST_COLUMNS, row)), default=str,
+                                            option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+        logger.info(f'Exported {exported} files of {user_obj.id}')
+
+    async def get_file_by_path(self, db: AsyncSession, user_obj: ModelType, path: str) -> ModelType | None:
         if path.startswith('/'):
             statement = select(self._model).where(self._model.path == os.path.normpath(path[1:]))
             logger.info(f'Get path of file {os.path.normpath(path[1:])}')
         else:
             statement = select(self._model).where(self._model.id == path)
             logger.info(f'Get id file {path}')
+        statement = statement.where(self._model.user_id == user_obj.id)
         files = await db.execute(statement=statement)
         result = files.scalar_one_or_none()
         return result
 
 
-    async def get_path_of_file(self, db: AsyncSession, path: str) -> str:
-        result = await self.get_file_by_path(db=db, path=path)
+    async def get_replaced_size(self, db: AsyncSession, user_obj: ModelType, path: str) -> int:
+        """Size of the user's file an upload to path overwrites, 0 when there is none."""
+        statement = select(self._model.size).where(self._model.user_id == user_obj.id,
+                                                   self._model.path == os.path.normpath(path.lstrip('/\\')))
+        return (await db.execute(statement=statement)).scalar_one_or_none() or 0
+
+    async def get_path_of_file(self, db: AsyncSession, user_obj: ModelType, path: str) -> ModelType:
+        result = await self.get_file_by_path(db=db, user_obj=user_obj, path=path)
         if not result:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -96,31 +481,93 @@ class RepositoryFileDB(Repository, Generic[ModelType]):
         return result
 
 
-    async def get_compression_file(self, db: AsyncSession, path: str, compression_type: str) -> Any:
+    def storage_path(self, file_obj: ModelType) -> str:
+        """Path of the file content relative to files_folder."""
+        if file_obj.digest:
+            return blob_store.relative_path(file_obj.digest)
+        return file_obj.path
+
+    def etag(self, file_obj: ModelType) -> str:
+        """Strong validator: the content digest, or size and write time for files stored before blobs."""
+        if file_obj.digest:
+            return f'"{file_obj.digest}"'
+        return f'"{file_obj.size:x}-{int(utc_timestamp(file_obj.created_at)):x}"'
+
+    def _in_directory(self, user_obj: ModelType, directory: str) -> Any:
+        """Files anywhere under directory ('' is the root), served by the (user_id, parent) index."""
+        condition = self._model.user_id == user_obj.id
+        if directory:
+            condition = and_(condition, or_(self._model.parent == directory,
+                                            self._model.parent.startswith(directory + '/', autoescape=True)))
+        return condition
+
+    async def get_directory_info(self, db: AsyncSession, user_obj: ModelType, path: str) -> dict:
+        """Direct children of a directory with recursive sizes and file counts, in one query."""
+        directory = normalize_directory(path)
+        offset = len(directory) + 2 if directory else 1
+        child = func.split_part(func.substr(self._model.path, offset), '/', 1).label('name')
+        statement = (select(child, func.count().label('files_count'), func.sum(self._model.size).label('size'),
+                            func.bool_and(self._model.parent == directory).label('is_file'))
+                     .where(self._in_directory(user_obj, directory)).group_by(child).order_by(child))
+        rows = (await db.execute(statement=statement)).all()
+        if directory and not rows:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Directory or file not found'
+            )
+        entries = [{'name': row.name, 'is_dir': not row.is_file, 'files_count': row.files_count,
+                    'size': int(row.size)} for row in rows]
+        return {'path': '/' + directory, 'files_count': sum(entry['files_count'] for entry in entries),
+                'size': sum(entry['size'] for entry in entries), 'entries': entries}
+
+    async def get_archive_entries(self, db: AsyncSession, user_obj: ModelType, path: str) -> list[tuple[str, str]]:
+        file_obj = await self.get_file_by_path(db=db, user_obj=user_obj, path=path)
+        if file_obj:
+            return [(os.path.join(settings.files_folder, self.storage_path(file_obj)), file_obj.name)]
+        if not path.startswith('/'):
+            return []
+        directory = normalize_directory(path)
+        statement = (select(self._model.path, self._model.digest)
+                     .where(self._in_directory(user_obj, directory)).order_by(self._model.path))
+        rows = (await db.execute(statement=statement)).all()
+        parent = os.path.dirname(directory)
+        return [(os.path.join(settings.files_folder, self.storage_path(row)),
+                 row.path[len(parent) + 1:] if parent else row.path) for row in rows]
+
+    async def get_compression_file(self, db: AsyncSession, user_obj: ModelType, path: str,
+                                   compression_type: str) -> Any:
+        """Returns (archive, media_type, archive name).
+
+        archive is the storage path of a cached archive, or a stream with close() that builds it.
+        """
         logger.info(f'Trying get file to compression {path}')
         if compression_type not in settings.compression_types:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail='Compression type is not supported.'
             )
-
-        file_obj = await self.get_file_by_path(db=db, path=path)
-        if not file_obj:
-            logger.info('No such file_obj in db')
-            if path.startswith('/'):
-                path = path[1:]
-            full_path = os.path.join(settings.files_folder, os.path.normpath(path))
-            if not os.path.isdir(full_path):
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail='Directory or file not found11'
-                )
-        else:
-            if path == str(file_obj.id):
-                full_path = os.path.join(settings.files_folder, file_obj.path)
-            else:
-                full_path = os.path.join(settings.files_folder, os.path.normpath(path[1:]))
-        logger.info(f'Trying begin compress file {full_path}')
-        result, media_type, arch_name = archive_file(compression_type, full_path)
-        return result, media_type, arch_name
-
+        entries = await self.get_archive_entries(db=db, user_obj=user_obj, path=path)
+        # nothing below needs the database, and waiting for a build or a job slot can take long
+        await db.close()
+        if not entries:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Directory or file not found'
+            )
+        _, media_type = ARCHIVERS[compression_type]
+        if not settings.archive_cache_enabled:
+            job = await compression_executor.submit(build_archive, compression_type, entries,
+                                                    settings.archive_chunk_size, label=compression_type)
+            return job, media_type, archive_name(compression_type)
+        key = await archive_cache.make_key(path, compression_type, entries)
+        cached = await archive_cache.acquire(key, compression_type)
+        if cached:
+            return cached, media_type, archive_name(compression_type)
+        logger.info(f'Trying begin compress {len(entries)} files from {path}')
+        try:
+            job = await compression_executor.submit(build_archive, compression_type, entries,
+                                                    settings.archive_chunk_size, label=compression_type)
+        except BaseException:
+            archive_cache.release(key)
+            raise
+        return archive_cache.stream(key, compression_type, job), media_type, archive_name(compression_type)
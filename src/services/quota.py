@@ -0,0 +1,118 @@
+from abc import ABC
+from datetime import datetime
+from typing import Generic, Optional, Type, TypeVar
+from uuid import UUID
+from fastapi import HTTPException
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+from src.db.db import Base
+from src.core import settings
+from src.core.logger import logger
+from src.models.models import File
+
+
+class Repository(ABC):
+    def check(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def charge(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_usage(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_files_version(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def reconcile(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+ModelType = TypeVar("ModelType", bound=Base)
+
+
+def quota_exceeded() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+        detail='Storage quota exceeded.'
+    )
+
+
+class RepositoryQuotaDB(Repository, Generic[ModelType]):
+    """Keeps used_bytes/files_count on the user row so quota checks never scan the user's files.
+
+    files_version is bumped with every change of the user's files and validates cached listings.
+    """
+
+    def __init__(self, model: Type[ModelType]):
+        self._model = model
+
+    def _quota(self):
+        if settings.default_quota_bytes is None:
+            return self._model.quota_bytes
+        return func.coalesce(self._model.quota_bytes, settings.default_quota_bytes)
+
+    async def get_usage(self, db: AsyncSession, user_id: UUID) -> dict:
+        statement = (select(self._model.used_bytes, self._model.files_count, self._quota().label('quota_bytes'))
+                     .where(self._model.id == user_id))
+        row = (await db.execute(statement=statement)).one()
+        return {'used_bytes': row.used_bytes, 'files_count': row.files_count, 'quota_bytes': row.quota_bytes}
+
+    async def get_files_version(self, db: AsyncSession, user_id: UUID) -> tuple[int, Optional[datetime]]:
+        statement = select(self._model.files_version, self._model.files_changed_at).where(self._model.id == user_id)
+        return tuple((await db.execute(statement=statement)).one())
+
+    async def check(self, db: AsyncSession, user_id: UUID, incoming: Optional[int], replaced: int = 0) -> None:
+        """Early rejection by a declared size (Content-Length, upload session size), before bytes are written.
+
+        replaced is the size of the file the upload overwrites, it is given back when the upload is stored.
+        """
+        if not incoming:
+            return
+        usage = await self.get_usage(db=db, user_id=user_id)
+        if usage['quota_bytes'] is not None and usage['used_bytes'] + incoming - replaced > usage['quota_bytes']:
+            raise quota_exceeded()
+
+    async def charge(self, db: AsyncSession, user_id: UUID, size_delta: int, count_delta: int) -> None:
+        """Moves the counters and the files version in the caller's transaction.
+
+        Growing past the quota raises 507 instead.
+        """
+        statement = (update(self._model).where(self._model.id == user_id)
+                     .values(used_bytes=self._model.used_bytes + size_delta,
+                             files_count=self._model.files_count + count_delta,
+                             files_version=self._model.files_version + 1,
+                             files_changed_at=datetime.utcnow())
+                     .returning(self._model.used_bytes))
+        if size_delta > 0:
+            quota = self._quota()
+            statement = statement.where(or_(quota.is_(None), self._model.used_bytes + size_delta <= quota))
+        if (await db.execute(statement=statement)).scalar_one_or_none() is None:
+            await db.rollback()
+            raise quota_exceeded()
+
+    async def reconcile(self, db: AsyncSession) -> int:
+        """Repairs counters that drifted from the files table, returns the number of fixed users.
+
+        Each candidate is recounted under its row lock, so concurrent uploads are not lost.
+        """
+        totals = (select(File.user_id, func.count().label('files_count'), func.sum(File.size).label('used_bytes'))
+                  .group_by(File.user_id).subquery())
+        candidates = (select(self._model.id)
+                      .outerjoin(totals, totals.c.user_id == self._model.id)
+                      .where(or_(self._model.used_bytes != func.coalesce(totals.c.used_bytes, 0),
+                                 self._model.files_count != func.coalesce(totals.c.files_count, 0))))
+        user_ids = (await db.execute(statement=candidates)).scalars().all()
+        await db.commit()
+        for user_id in user_ids:
+            await db.execute(select(self._model.id).where(self._model.id == user_id).with_for_update())
+            recount = select(func.count(), func.coalesce(func.sum(File.size), 0)).where(File.user_id == user_id)
+            files_count, used_bytes = (await db.execute(statement=recount)).one()
+            await db.execute(update(self._model).where(self._model.id == user_id)
+                             .values(used_bytes=used_bytes, files_count=files_count))
+            await db.commit()
+        if user_ids:
+            logger.warning(f'Reconciled storage usage of {len(user_ids)} users')
+        return len(user_ids)
@@ -0,0 +1,276 @@
+from abc import ABC
+import os
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Generic, Optional, Type, TypeVar
+from uuid import UUID
+from fastapi import HTTPException
+from sqlalchemy import String, any_, bindparam, delete, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+
+from src.db.db import Base
+from src.core import settings
+from src.core.logger import logger
+from src.models.models import BlobChunk, File, UploadChunk
+from src.schemes.upload_schemes import DeltaUploadCreate, UploadSessionCreate
+from src.services.blob import blob_store
+from src.services.quota import RepositoryQuotaDB
+from src.utils.tools import copy_range, hash_chunks, hash_path
+
+
+class Repository(ABC):
+    def create_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def get_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def create_delta_session(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def write_chunk(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def finalize(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def cleanup_expired(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+ModelType = TypeVar("ModelType", bound=Base)
+
+
+def merge_ranges(chunks: list[tuple[int, int]]) -> list[list[int]]:
+    """Merges (offset, size) pairs into sorted, non-overlapping [start, end) ranges."""
+    ranges: list[list[int]] = []
+    for offset, size in sorted(chunks):
+        if ranges and offset <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], offset + size)
+        else:
+            ranges.append([offset, offset + size])
+    return ranges
+
+
+def _open_data_file(full_file_path: str, size: int) -> int:
+    os.makedirs(os.path.dirname(full_file_path), exist_ok=True)
+    fd = os.open(full_file_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+    return fd
+
+
+def _prefill(full_file_path: str, size: int, copies: list[tuple[str, int, int, int]]) -> set[int]:
+    """Blocking: copies (source path, source offset, offset, size) ranges of stored blobs into the session file.
+
+    Returns the indexes of the copies that failed, e.g. because the blob was deleted meanwhile.
+    """
+    failed = set()
+    sources: dict[str, int] = {}
+    fd = _open_data_file(full_file_path, size)
+    try:
+        for index, (source_path, source_offset, offset, length) in enumerate(copies):
+            try:
+                if source_path not in sources:
+                    sources[source_path] = os.open(source_path, os.O_RDONLY)
+                copy_range(sources[source_path], source_offset, fd, offset, length, settings.upload_chunk_size)
+            except OSError:
+                failed.add(index)
+    finally:
+        for source_fd in sources.values():
+            os.close(source_fd)
+        os.close(fd)
+    return failed
+
+
+class RepositoryUploadDB(Repository, Generic[ModelType]):
+    def __init__(self, model: Type[ModelType], quota: RepositoryQuotaDB):
+        self._model = model
+        self._quota = quota
+
+    @staticmethod
+    def data_path(session_id: UUID) -> str:
+        return os.path.join(settings.files_folder, settings.uploads_folder_name, str(session_id))
+
+    @staticmethod
+    def _expires_at() -> datetime:
+        return datetime.utcnow() + timedelta(seconds=settings.upload_session_ttl_seconds)
+
+    async def create_session(self, db: AsyncSession, user_obj: ModelType, obj_in: UploadSessionCreate) -> ModelType:
+        path = os.path.normpath(obj_in.path.lstrip('/\\'))
+        if obj_in.size < 0 or path in ('', '.'):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Path must point to a file and size can not be negative.'
+            )
+        replaced = await db.scalar(select(File.size).where(File.user_id == user_obj.id, File.path == path))
+        await self._quota.check(db=db, user_id=user_obj.id, incoming=obj_in.size, replaced=replaced or 0)
+        upload = self._model(user_id=user_obj.id, name=os.path.basename(path), path=path, size=obj_in.size,
+                             expires_at=self._expires_at())
+        db.add(upload)
+        await db.commit()
+        await db.refresh(upload)
+        fd = await run_in_threadpool(_open_data_file, self.data_path(upload.id), upload.size)
+        os.close(fd)
+        logger.info(f'Create upload session {upload.id} for {path}')
+        return upload
+
+    async def create_delta_session(self, db: AsyncSession, user_obj: ModelType,
+                                   obj_in: DeltaUploadCreate) -> tuple[ModelType, list[dict]]:
+        """Starts an upload session for a file described by its content-defined chunk manifest.
+
+        Chunks already stored in the user's files are copied into the session file on the server and
+        count as received; the rest is returned as missing, to be PUT at its offset before finalize.
+        """
+        if len(obj_in.chunks) > settings.delta_upload_max_chunks or not all(
+                0 < chunk.size <= settings.delta_upload_max_chunk_size for chunk in obj_in.chunks):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'At most {settings.delta_upload_max_chunks} chunks of 1 to '
+                       f'{settings.delta_upload_max_chunk_size} bytes are accepted.'
+            )
+        chunks = []
+        offset = 0
+        for chunk in obj_in.chunks:
+            chunks.append((chunk.digest, offset, chunk.size))
+            offset += chunk.size
+        upload = await self.create_session(db=db, user_obj=user_obj,
+                                           obj_in=UploadSessionCreate(path=obj_in.path, size=offset))
+        upload.manifest = [[digest, size] for digest, _, size in chunks]
+        # the version being replaced may have been stored by a plain upload, without a chunk index
+        current = await db.scalar(select(File.digest).where(File.user_id == user_obj.id, File.path == upload.path))
+        if current is not None:
+            await blob_store.index_blob(db=db, digest=current)
+        # only the user's own files, so a manifest can not probe what other users store
+        statement = (select(BlobChunk.digest, BlobChunk.blob_digest, BlobChunk.offset)
+                     .join(File, File.digest == BlobChunk.blob_digest)
+                     .where(File.user_id == user_obj.id,
+                            BlobChunk.digest == any_(bindparam('digests', type_=ARRAY(String))))
+                     .distinct(BlobChunk.digest))
+        rows = await db.execute(statement, {'digests': list({digest for digest, _, _ in chunks})})
+        sources = {row.digest: (blob_store.path(row.blob_digest), row.offset) for row in rows}
+        reusable = [chunk for chunk in chunks if chunk[0] in sources]
+        copies = [(*sources[digest], offset, size) for digest, offset, size in reusable]
+        failed = await run_in_threadpool(_prefill, self.data_path(upload.id), upload.size, copies)
+        received = [(offset, size) for index, (_, offset, size) in enumerate(reusable) if index not in failed]
+        if received:
+            await db.execute(insert(UploadChunk), [{'session_id': upload.id, 'offset': start, 'size': end - start}
+                                                   for start, end in merge_ranges(received)])
+        await db.commit()
+        received_offsets = {offset for offset, _ in received}
+        missing = [{'offset': offset, 'size': size, 'digest': digest}
+                   for digest, offset, size in chunks if offset not in received_offsets]
+        logger.info(f'Delta upload {upload.id}: {len(chunks) - len(missing)} of {len(chunks)} chunks reused')
+        return upload, missing
+
+    async def get_session(self, db: AsyncSession, user_obj: ModelType, session_id: UUID,
+                          lock: bool = False) -> ModelType:
+        """lock reads the row again with SELECT ... FOR UPDATE, held until the caller commits."""
+        upload = await db.get(self._model, session_id, with_for_update=True if lock else None)
+        if not upload or upload.user_id != user_obj.id or upload.expires_at < datetime.utcnow():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail='Upload session not found'
+            )
+        return upload
+
+    async def get_received(self, db: AsyncSession, session_id: UUID) -> list[list[int]]:
+        statement = select(UploadChunk.offset, UploadChunk.size).where(UploadChunk.session_id == session_id)
+        chunks = await db.execute(statement=statement)
+        return merge_ranges([tuple(chunk) for chunk in chunks.all()])
+
+    async def write_chunk(self, db: AsyncSession, user_obj: ModelType, session_id: UUID, offset: int,
+                          stream: AsyncIterator[bytes]) -> ModelType:
+        """Writes the request body straight into the session file at the given offset.
+
+        No connection is held while the body is received: the session row is read and the transaction
+        ends, the chunk is recorded afterwards in a short one that checks the session again.
+        """
+        upload = await self.get_session(db=db, user_obj=user_obj, session_id=session_id)
+        if offset < 0 or offset > upload.size:
+            raise HTTPException(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                detail='Offset is out of the file size.'
+            )
+        await db.commit()
+        fd = await run_in_threadpool(_open_data_file, self.data_path(upload.id), upload.size)
+        written = 0
+        buffer = bytearray()
+        try:
+            async for data in stream:
+                if offset + written + len(buffer) + len(data) > upload.size:
+                    raise HTTPException(
+                        status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                        detail='Chunk exceeds the declared file size.'
+                    )
+                buffer += data
+                if len(buffer) >= settings.upload_chunk_size:
+                    written += await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+                    buffer.clear()
+            if buffer:
+                written += await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+        finally:
+            os.close(fd)
+        # finalized or expired meanwhile: the bytes went to a file nobody reads any more
+        upload = await self.get_session(db=db, user_obj=user_obj, session_id=session_id, lock=True)
+        if offset + written > upload.size:
+            raise HTTPException(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                detail='Chunk exceeds the declared file size.'
+            )
+        if written:
+            statement = insert(UploadChunk).values(session_id=upload.id, offset=offset, size=written)
+            statement = statement.on_conflict_do_update(
+                index_elements=[UploadChunk.session_id, UploadChunk.offset],
+                set_={'size': statement.excluded.size},
+            )
+            await db.execute(statement)
+        upload.expires_at = self._expires_at()
+        await db.commit()
+        return upload
+
+    async def finalize(self, db: AsyncSession, user_obj: ModelType,
+                       session_id: UUID) -> tuple[str, str, str, int, Optional[list]]:
+        """Checks that every byte arrived and hashes the data file.
+
+        Returns (path, name, digest, size, chunk manifest of a delta upload) for the File row, which
+        adopts data_path() into the blob store; the session is removed with that commit.
+        """
+        upload = await self.get_session(db=db, user_obj=user_obj, session_id=session_id, lock=True)
+        received = await self.get_received(db=db, session_id=upload.id)
+        if upload.size and received != [[0, upload.size]]:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail='Upload is not complete yet.'
+            )
+        data_path = self.data_path(upload.id)
+        if upload.manifest:
+            digest, size, mismatched = await run_in_threadpool(hash_chunks, data_path, upload.manifest,
+                                                               settings.upload_chunk_size)
+            if mismatched:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f'Chunks at offsets {mismatched[:10]} do not match the manifest, upload them again.'
+                )
+        else:
+            digest, size = await run_in_threadpool(hash_path, data_path, settings.upload_chunk_size)
+        result = upload.path, upload.name, digest, size, upload.manifest
+        await db.delete(upload)
+        logger.info(f'Finalize upload session {upload.id} as blob {digest}')
+        return result
+
+    async def cleanup_expired(self, db: AsyncSession) -> int:
+        statement = delete(self._model).where(self._model.expires_at < datetime.utcnow()).returning(self._model.id)
+        expired = (await db.execute(statement=statement)).scalars().all()
+        await db.commit()
+        for session_id in expired:
+            try:
+                await run_in_threadpool(os.unlink, self.data_path(session_id))
+            except FileNotFoundError:
+                pass
+        if expired:
+            logger.info(f'Removed {len(expired)} expired upload sessions')
+        return len(expired)
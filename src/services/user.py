@@ -5,15 +5,18 @@ from fastapi import Depends
 from fastapi import HTTPException
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.util import await_only
 from fastapi.security import OAuth2PasswordBearer
 from starlette import status
 from jose import JWTError, jwt
 
 from src.db.db import Base, get_session
-from src.schemes.user_schemes import TokenData
+from src.schemes.user_schemes import CurrentUser, TokenData
 from src.core import settings
-from src.utils.tools import get_password_hash, verify_password, create_access_token
+from src.utils.cache import make_cache
+from src.utils.tools import get_password_hash_async, verify_password_async, create_access_token
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='v1/authorization/token')
 
@@ -38,10 +41,37 @@ CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
     def __init__(self, model: Type[ModelType]):
         self._model = model
+        self.cache = make_cache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl_seconds,
+                                url=settings.user_cache_url, namespace='user',
+                                dumps=lambda user: user.json(), loads=CurrentUser.parse_raw)
+        event.listen(model, 'after_update', self._on_user_changed)
+        event.listen(model, 'after_delete', self._on_user_changed)
+        event.listen(Session, 'after_commit', self._on_commit)
+        event.listen(Session, 'after_rollback', self._on_rollback)
+
+    def _on_user_changed(self, mapper, connection, target) -> None:
+        """ORM hook: remembers the old and the new username of a changed user until the commit."""
+        history = inspect(target).attrs.username.history
+        object_session(target).info.setdefault('changed_users', set()).update({target.username, *history.deleted})
+
+    def _on_commit(self, session: Session) -> None:
+        """Session hook: drops cached entries of users changed in the transaction once it is committed.
+
+        Runs inside AsyncSession.commit(), so the entries are gone before the commit returns; a request
+        resolving the user meanwhile can only cache the row as it was before the commit.
+        """
+        for username in session.info.pop('changed_users', ()):
+            await_only(self.invalidate_user(username))
+
+    def _on_rollback(self, session: Session) -> None:
+        session.info.pop('changed_users', None)
+
+    async def invalidate_user(self, username: str) -> None:
+        await self.cache.invalidate(username)
 
     async def create_user(self, db: AsyncSession, *, obj_in: CreateSchemaType) -> ModelType:
         obj_in_data = jsonable_encoder(obj_in)
-        hash_pass = get_password_hash(obj_in_data.pop('password'))
+        hash_pass = await get_password_hash_async(obj_in_data.pop('password'))
         obj_in_data['password'] = hash_pass
         db_obj = self._model(**obj_in_data)
         print(obj_in_data)
@@ -63,7 +93,7 @@ class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail='User with this username exists.'
             )
-        if not verify_password(obj_in.password, user_obj.password):
+        if not await verify_password_async(obj_in.password, user_obj.password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
@@ -87,8 +117,13 @@ class RepositoryUserDB(Repository, Generic[ModelType, CreateSchemaType]):
             token_data = TokenData(username=username)
         except JWTError:
             raise credentials_exception
+        current_user = await self.cache.get(username)
+        if current_user is not None:
+            return current_user
         user_obj = await self.get_user_obj(db=db, obj_in=token_data)
         if user_obj is None:
             raise credentials_exception
-        return user_obj
+        current_user = CurrentUser.from_orm(user_obj)
+        await self.cache.set(username, current_user)
+        return current_user
 
@@ -1,14 +1,37 @@
 import asyncio
+import hashlib
+import io
+import json
+import logging
 import os
+import queue
+import tarfile
+import threading
+from email.utils import formatdate, parsedate_to_datetime
 from http import HTTPStatus
 from pathlib import Path
 import aiofile as aiofile
 import pytest
 import pytest_asyncio
+import pyzstd
 from httpx import AsyncClient
+from sqlalchemy import func, select, update
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 from .main import app
 from src.core.config import settings
+from src.core.logger import JsonFormatter, LogSampler, RateLimitFilter
+from src.db.db import async_session, pool_stats
+from src.models.models import Blob, File, User
+from src.relayout import migrate_legacy, relayout_blobs
+from src.services.base import file_service, quota_service, user_service
+from src.services.blob import blob_store
+from src.utils.layout import StorageLayout
+from src.utils.cache import TTLCache
+from src.utils.cdc import chunk_manifest
+from src.utils.archive_cache import archive_cache
+from src.utils.executor import _produce, compression_executor
 
 
 @pytest.fixture(scope="session")
@@ -112,7 +135,8 @@ async def test_download_file(auth_client_with_file):
                                                        headers=auth_client_with_file.headers)
     response = await auth_client_with_file.send(download_req, stream=True)
     assert response.status_code == HTTPStatus.TEMPORARY_REDIRECT
-    assert response.headers['Location'] == settings.static_url + '/testdir/testfile123'
+    digest = hashlib.sha256(b'test').hexdigest()
+    assert response.headers['Location'] == f'{settings.static_url}/blobs/{digest[:2]}/{digest[2:4]}/{digest}'
 
 
 @pytest.mark.asyncio
@@ -129,3 +153,626 @@ async def test_download_file_in_archive(auth_client_with_file_to_arch):
     assert os.path.exists(result_path)
     assert os.path.getsize(result_path) > 0
     os.remove(result_path)
+
+
+@pytest.mark.asyncio
+async def test_download_dir_in_tar_stream(auth_client):
+    test_file_name = 'testfile_tar'
+    with open(test_file_name, 'w+') as f:
+        f.write('test')
+    file = {'file': Path(test_file_name).open('rb')}
+    await auth_client.post('/api/v1/files/upload', params={'path': '/tardir'}, files=file)
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/tardir', 'compression': 'tar'})
+    assert response.status_code == HTTPStatus.OK
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        assert 'tardir/testfile_tar' in tar.getnames()
+
+
+@pytest.mark.asyncio
+async def test_identical_uploads_share_blob(auth_client):
+    test_file_name = 'testfile_dedup'
+    with open(test_file_name, 'w+') as f:
+        f.write('same content')
+    locations = []
+    for folder in ('/dedup1', '/dedup2'):
+        file = {'file': Path(test_file_name).open('rb')}
+        response = await auth_client.post('/api/v1/files/upload', params={'path': folder}, files=file)
+        assert response.status_code == HTTPStatus.CREATED
+        response = await auth_client.get('/api/v1/files/download', params={'path': f'{folder}/{test_file_name}'})
+        locations.append(response.headers['Location'])
+    assert locations[0] == locations[1]
+
+
+@pytest.mark.asyncio
+async def test_resumable_upload(auth_client):
+    content = b'0123456789' * 100
+    response = await auth_client.post('/api/v1/files/uploads/', json={'path': '/resumable/data.bin',
+                                                                      'size': len(content)})
+    assert response.status_code == HTTPStatus.CREATED
+    session_id = response.json()['id']
+    response = await auth_client.put(f'/api/v1/files/uploads/{session_id}', params={'offset': 500},
+                                     content=content[500:])
+    assert response.json()['received'] == [[500, len(content)]]
+    response = await auth_client.post(f'/api/v1/files/uploads/{session_id}/finalize')
+    assert response.status_code == HTTPStatus.CONFLICT
+    await auth_client.put(f'/api/v1/files/uploads/{session_id}', params={'offset': 0}, content=content[:500])
+    response = await auth_client.post(f'/api/v1/files/uploads/{session_id}/finalize')
+    assert response.status_code == HTTPStatus.CREATED
+    assert response.json()['size'] == len(content)
+    assert response.json()['path'] == 'resumable/data.bin'
+
+
+@pytest.mark.asyncio
+async def test_upload_chunk_streams_without_a_connection(auth_client):
+    response = await auth_client.post('/api/v1/files/uploads/', json={'path': '/resumable/pool.bin', 'size': 200})
+    session_id = response.json()['id']
+    checked_out = []
+
+    async def body():
+        for part in (b'a' * 100, b'b' * 100):
+            checked_out.append(pool_stats()['checked_out'])
+            yield part
+
+    response = await auth_client.put(f'/api/v1/files/uploads/{session_id}', params={'offset': 0}, content=body())
+    assert response.json()['received'] == [[0, 200]]
+    assert checked_out == [0, 0]
+
+
+@pytest.mark.asyncio
+async def test_delta_upload_sends_only_changed_chunks(auth_client):
+    async def delta_upload(content):
+        manifest = chunk_manifest(io.BytesIO(content), min_size=2048, avg_size=8192, max_size=32768)
+        response = await auth_client.post('/api/v1/files/uploads/delta',
+                                          json={'path': '/deltadir/image.bin', 'chunks': manifest})
+        assert response.status_code == HTTPStatus.CREATED
+        session = response.json()
+        for chunk in session['missing']:
+            await auth_client.put(f'/api/v1/files/uploads/{session["id"]}', params={'offset': chunk['offset']},
+                                  content=content[chunk['offset']:chunk['offset'] + chunk['size']])
+        response = await auth_client.post(f'/api/v1/files/uploads/{session["id"]}/finalize')
+        assert response.status_code == HTTPStatus.CREATED
+        assert response.json()['digest'] == hashlib.sha256(content).hexdigest()
+        return len(manifest), len(session['missing'])
+
+    content = os.urandom(256 * 1024)
+    chunks, missing = await delta_upload(content)
+    assert missing == chunks
+    changed = content[:100000] + b'inserted' + content[100000:]
+    chunks, missing = await delta_upload(changed)
+    assert missing <= 2 < chunks
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/deltadir/image.bin'})
+    assert response.headers['location'].endswith(hashlib.sha256(changed).hexdigest())
+
+
+@pytest.mark.asyncio
+async def test_delta_upload_reuses_a_plainly_uploaded_file(auth_client, monkeypatch):
+    sizes = {'min_size': 2048, 'avg_size': 8192, 'max_size': 32768}
+    for name, value in sizes.items():
+        monkeypatch.setattr(settings, f'delta_chunk_{name}', value)
+    content = os.urandom(256 * 1024)
+    response = await auth_client.post('/api/v1/files/upload', params={'path': '/deltaplain'},
+                                      files={'file': ('image.bin', content)})
+    assert response.status_code == HTTPStatus.CREATED
+    manifest = chunk_manifest(io.BytesIO(content), **sizes)
+    offset = sum(chunk['size'] for chunk in manifest[:3])
+    # bytes before min_size never enter the boundary hash, so only the fourth chunk changes
+    changed = bytearray(content)
+    changed[offset + 100] ^= 0xff
+    response = await auth_client.post('/api/v1/files/uploads/delta', json={
+        'path': '/deltaplain/image.bin', 'chunks': chunk_manifest(io.BytesIO(bytes(changed)), **sizes)})
+    assert response.status_code == HTTPStatus.CREATED
+    assert [chunk['offset'] for chunk in response.json()['missing']] == [offset]
+
+
+@pytest.mark.asyncio
+async def test_conditional_listing_and_download(auth_client):
+    await upload_test_file(auth_client, 'testfile_etag', '/etagdir')
+    response = await auth_client.get('/api/v1/files/', params={'prefix': '/etagdir'})
+    etag = response.headers['etag']
+    response = await auth_client.get('/api/v1/files/', params={'prefix': '/etagdir'},
+                                     headers={'If-None-Match': etag})
+    assert (response.status_code, response.content) == (HTTPStatus.NOT_MODIFIED, b'')
+    response = await auth_client.get('/api/v1/files/', params={'prefix': '/other'}, headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.OK
+    await upload_test_file(auth_client, 'testfile_etag2', '/etagdir')
+    response = await auth_client.get('/api/v1/files/', params={'prefix': '/etagdir'},
+                                     headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.OK and len(response.json()['files']) == 2
+    digest_etag = '"' + hashlib.sha256(b'test').hexdigest() + '"'
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/etagdir/testfile_etag'},
+                                     headers={'If-None-Match': digest_etag})
+    assert (response.status_code, response.headers['etag']) == (HTTPStatus.NOT_MODIFIED, digest_etag)
+
+
+@pytest.mark.asyncio
+async def test_export_files_ndjson(auth_client):
+    await upload_test_file(auth_client, 'testfile_export1', '/exportdir')
+    response = await auth_client.get('/api/v1/files/export')
+    assert response.headers['content-encoding'] == 'gzip'
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    first = next(line for line in lines if line['path'] == 'exportdir/testfile_export1')
+    await upload_test_file(auth_client, 'testfile_export2', '/exportdir')
+    response = await auth_client.get('/api/v1/files/export', params={'since': first['created_at']},
+                                     headers={'Accept-Encoding': 'zstd'})
+    assert response.headers['content-encoding'] == 'zstd'
+    lines = pyzstd.decompress(response.content).decode().splitlines()
+    assert [json.loads(line)['path'] for line in lines] == ['exportdir/testfile_export2']
+
+
+async def upload_test_file(client, file_name, folder, content='test'):
+    with open(file_name, 'w+') as f:
+        f.write(content)
+    file = {'file': Path(file_name).open('rb')}
+    return await client.post('/api/v1/files/upload', params={'path': folder}, files=file)
+
+
+@pytest.mark.asyncio
+async def test_download_file_accel_redirect(auth_client, monkeypatch):
+    await upload_test_file(auth_client, 'testfile_accel', '/acceldir')
+    monkeypatch.setattr(settings, 'download_mode', 'accel')
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/acceldir/testfile_accel'})
+    assert response.status_code == HTTPStatus.OK
+    digest = hashlib.sha256(b'test').hexdigest()
+    assert response.headers['X-Accel-Redirect'] == f'/protected_files/blobs/{digest[:2]}/{digest[2:4]}/{digest}'
+    assert 'testfile_accel' in response.headers['Content-Disposition']
+    assert response.headers['ETag'] == f'"{digest}"'
+
+
+@pytest.mark.asyncio
+async def test_download_foreign_file_not_found(auth_client):
+    await upload_test_file(auth_client, 'testfile_private', '/privatedir')
+    await auth_client.post('/api/v1/register/', json={"username": 'test_user_other', "password": 'testpass'})
+    response = await auth_client.post('/api/v1/auth/', json={"username": 'test_user_other', "password": 'testpass'})
+    headers = {'Authorization': 'Bearer ' + response.json()['access_token']}
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/privatedir/testfile_private'},
+                                     headers=headers)
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_download_file_stream_ranges(auth_client, monkeypatch):
+    await upload_test_file(auth_client, 'testfile_ranges', '/rangedir', content='0123456789')
+    monkeypatch.setattr(settings, 'download_mode', 'stream')
+    params = {'path': '/rangedir/testfile_ranges'}
+    response = await auth_client.get('/api/v1/files/download', params=params)
+    assert response.status_code == HTTPStatus.OK
+    assert response.content == b'0123456789'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+    response = await auth_client.get('/api/v1/files/download', params=params, headers={'Range': 'bytes=2-4'})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.content == b'234'
+    assert response.headers['Content-Range'] == 'bytes 2-4/10'
+
+    response = await auth_client.get('/api/v1/files/download', params=params, headers={'Range': 'bytes=0-1,-2'})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.headers['Content-Type'].startswith('multipart/byteranges')
+    assert int(response.headers['Content-Length']) == len(response.content)
+    assert b'Content-Range: bytes 8-9/10\r\n\r\n89' in response.content
+
+    response = await auth_client.get('/api/v1/files/download', params=params, headers={'Range': 'bytes=5-6,0-2,2-4'})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.headers['Content-Range'] == 'bytes 0-6/10'
+    assert response.content == b'0123456'
+
+    response = await auth_client.get('/api/v1/files/download', params=params,
+                                     headers={'Range': 'bytes=' + ','.join(['0-0'] * 16)})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    response = await auth_client.get('/api/v1/files/download', params=params,
+                                     headers={'Range': 'bytes=' + ','.join(['0-0'] * 17)})
+    assert response.status_code == HTTPStatus.OK
+
+    response = await auth_client.get('/api/v1/files/download', params=params,
+                                     headers={'Range': 'bytes=2-4', 'If-Range': '"stale"'})
+    assert response.status_code == HTTPStatus.OK
+    last_modified = response.headers['Last-Modified']
+    response = await auth_client.get('/api/v1/files/download', params=params,
+                                     headers={'Range': 'bytes=2-4', 'If-Range': last_modified})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    later = formatdate(parsedate_to_datetime(last_modified).timestamp() + 3600, usegmt=True)
+    response = await auth_client.get('/api/v1/files/download', params=params,
+                                     headers={'Range': 'bytes=2-4', 'If-Range': later})
+    assert response.status_code == HTTPStatus.OK
+
+    response = await auth_client.get('/api/v1/files/download', params=params, headers={'Range': 'bytes=20-'})
+    assert response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
+@pytest.mark.asyncio
+async def test_get_list_paginated(auth_client):
+    for index in range(3):
+        await upload_test_file(auth_client, f'testfile_page{index}', '/pagedir', content='x' * (index + 1))
+    await upload_test_file(auth_client, 'testfile_sibling', '/pagedir2', content='x' * 10)
+    params = {'prefix': '/pagedir', 'sort': 'size', 'order': 'desc', 'limit': 2}
+    response = await auth_client.get('/api/v1/files/', params=params)
+    assert response.status_code == HTTPStatus.OK
+    first_page = response.json()
+    assert [file['size'] for file in first_page['files']] == [3, 2]
+    assert first_page['next_cursor']
+    response = await auth_client.get('/api/v1/files/', params={**params, 'cursor': first_page['next_cursor']})
+    second_page = response.json()
+    assert [file['size'] for file in second_page['files']] == [1]
+    assert second_page['next_cursor'] is None
+    response = await auth_client.get('/api/v1/files/', params={'prefix': '/pagedir/testfile_page0'})
+    assert [file['path'] for file in response.json()['files']] == ['pagedir/testfile_page0']
+
+
+@pytest.mark.asyncio
+async def test_user_cache_lru_and_ttl():
+    cache = TTLCache(maxsize=2, ttl=10)
+    await cache.set('a', 1)
+    await cache.set('b', 2)
+    assert await cache.get('a') == 1
+    await cache.set('c', 3)
+    assert await cache.get('b') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['evictions'] == 1
+    expired = TTLCache(maxsize=2, ttl=-1)
+    await expired.set('a', 1)
+    assert await expired.get('a') is None
+
+
+@pytest.mark.asyncio
+async def test_user_cache_invalidated_on_commit(auth_client):
+    await auth_client.get('/api/v1/files/usage')
+    assert await user_service.cache.get('test_user') is not None
+    async with async_session() as session:
+        user = (await session.execute(select(User).where(User.username == 'test_user'))).scalar_one()
+        user.quota_bytes = 10 ** 12
+        await session.flush()
+        assert await user_service.cache.get('test_user') is not None
+        await session.commit()
+        assert await user_service.cache.get('test_user') is None
+        user.quota_bytes = None
+        await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_download_archive_from_cache(auth_client, monkeypatch):
+    await upload_test_file(auth_client, 'testfile_cached', '/cachedir')
+    params = {'path': '/cachedir', 'compression': 'zip'}
+    first, second = await asyncio.gather(auth_client.get('/api/v1/files/download', params=params),
+                                         auth_client.get('/api/v1/files/download', params=params))
+    assert first.status_code == second.status_code == HTTPStatus.OK
+    assert first.content == second.content
+    response = await auth_client.get('/api/v1/files/download', params=params)
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.content == first.content
+    stale, fresh = (os.path.join(archive_cache.folder, name) for name in ('.tmp-stale', '.tmp-fresh'))
+    for tmp_path in (stale, fresh):
+        Path(tmp_path).touch()
+    os.utime(stale, (0, 0))
+    await archive_cache.sweep()
+    assert not os.path.exists(stale) and os.path.exists(fresh)
+    # over max_bytes only archives not served recently are evicted
+    old, served = (os.path.join(archive_cache.folder, name) for name in ('old.zip', 'served.zip'))
+    for archive_path in (old, served):
+        Path(archive_path).write_bytes(b'archive')
+    os.utime(old, (0, 0))
+    monkeypatch.setattr(archive_cache, 'max_bytes', 0)
+    await archive_cache.sweep()
+    assert not os.path.exists(old) and os.path.exists(served)
+
+
+@pytest.mark.asyncio
+async def test_archive_waits_without_a_connection(auth_client, monkeypatch):
+    await upload_test_file(auth_client, 'testfile_slot', '/slotdir')
+    submit = compression_executor.submit
+    checked_out = []
+
+    async def counting_submit(*args, **kwargs):
+        checked_out.append(pool_stats()['checked_out'])
+        return await submit(*args, **kwargs)
+
+    monkeypatch.setattr(compression_executor, 'submit', counting_submit)
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/slotdir', 'compression': 'tar'})
+    assert response.status_code == HTTPStatus.OK
+    assert checked_out == [0]
+
+
+@pytest.mark.asyncio
+async def test_get_directory_info(auth_client):
+    await upload_test_file(auth_client, 'testfile_top', '/treedir', content='12')
+    await upload_test_file(auth_client, 'testfile_deep', '/treedir/sub/deeper', content='345')
+    response = await auth_client.get('/api/v1/files/directory', params={'path': '/treedir'})
+    assert response.status_code == HTTPStatus.OK
+    info = response.json()
+    assert (info['files_count'], info['size']) == (2, 5)
+    assert info['entries'] == [
+        {'name': 'sub', 'is_dir': True, 'files_count': 1, 'size': 3},
+        {'name': 'testfile_top', 'is_dir': False, 'files_count': 1, 'size': 2},
+    ]
+    response = await auth_client.get('/api/v1/files/directory', params={'path': '/no-such-dir'})
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_upload_files_batch(auth_client):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for name, content in (('nested/a.txt', b'aaa'), ('../escape.txt', b'x')):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    files = [('files', ('one.txt', b'1')), ('files', ('sub/two.txt', b'22')), ('files', ('one.txt', b'1')),
+             ('files', ('..dots.txt', b'4')), ('archive', ('batch.tar', archive.getvalue()))]
+    response = await auth_client.post('/api/v1/files/batch', params={'path': '/batchdir'}, files=files)
+    assert response.status_code == HTTPStatus.OK
+    result = response.json()
+    assert (result['created'], result['updated'], result['failed']) == (4, 0, 2)
+    assert [(item['path'], item['status']) for item in result['items']] == [
+        ('batchdir/one.txt', 201), ('batchdir/sub/two.txt', 201), ('batchdir/one.txt', 409),
+        ('batchdir/..dots.txt', 201), ('batchdir/nested/a.txt', 201), ('../escape.txt', 400),
+    ]
+    response = await auth_client.get('/api/v1/files/directory', params={'path': '/batchdir'})
+    assert (response.json()['files_count'], response.json()['size']) == (4, 7)
+
+
+@pytest.mark.asyncio
+async def test_upload_overwrites_existing_path(auth_client):
+    await upload_test_file(auth_client, 'testfile_overwrite', '/overwritedir', content='old')
+    response = await upload_test_file(auth_client, 'testfile_overwrite', '/overwritedir', content='newer')
+    assert response.status_code == HTTPStatus.CREATED
+    assert response.json()['size'] == 5
+    response = await auth_client.get('/api/v1/files/', params={'prefix': '/overwritedir'})
+    assert [file['size'] for file in response.json()['files']] == [5]
+    digest = hashlib.sha256(b'old').hexdigest()
+    assert not os.path.exists(os.path.join(settings.files_folder, 'blobs', digest[:2], digest[2:4], digest))
+    await auth_client.post('/api/v1/register/', json={'username': 'other_user', 'password': 'otherpass'})
+    response = await auth_client.post('/api/v1/auth/', json={'username': 'other_user', 'password': 'otherpass'})
+    auth_client.headers = {'Authorization': 'Bearer ' + response.json()['access_token']}
+    response = await upload_test_file(auth_client, 'testfile_overwrite', '/overwritedir', content='foreign')
+    assert response.status_code == HTTPStatus.CONFLICT
+
+
+@pytest.mark.asyncio
+async def test_streamed_upload_stores_checksum(auth_client, monkeypatch):
+    monkeypatch.setattr(settings, 'upload_chunk_size', 1000)
+    monkeypatch.setattr(settings, 'upload_queue_depth', 1)
+    content = os.urandom(10 * 1000 + 7)
+    files = {'note': (None, 'skipped'), 'file': ('streamed.bin', content)}
+    response = await auth_client.post('/api/v1/files/upload', params={'path': '/streamdir'}, files=files)
+    assert response.status_code == HTTPStatus.CREATED
+    digest = hashlib.sha256(content).hexdigest()
+    assert (response.json()['size'], response.json()['digest']) == (len(content), digest)
+    with open(os.path.join(settings.files_folder, 'blobs', digest[:2], digest[2:4], digest), 'rb') as stored:
+        assert stored.read() == content
+    response = await auth_client.post('/api/v1/files/upload', params={'path': '/streamdir'},
+                                      files={'other': ('streamed.bin', content)})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_upload_streams_without_a_connection(auth_client, monkeypatch):
+    ingest = blob_store.ingest
+    checked_out = []
+
+    async def counting_ingest(chunks):
+        checked_out.append(pool_stats()['checked_out'])
+        return await ingest(chunks)
+
+    monkeypatch.setattr(blob_store, 'ingest', counting_ingest)
+    response = await upload_test_file(auth_client, 'testfile_pool', '/pooldir')
+    assert response.status_code == HTTPStatus.CREATED
+    assert checked_out == [0]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_overwrites_release_the_replaced_blob(auth_client, monkeypatch):
+    charge = quota_service.charge
+
+    async def slow_charge(**kwargs):
+        # keeps the first transaction open until the second one is waiting on the same row
+        await asyncio.sleep(0.2)
+        await charge(**kwargs)
+
+    await upload_test_file(auth_client, 'testfile_race', '/racedir', content='orig')
+    await upload_test_file(auth_client, 'testfile_race_copy', '/racedir', content='orig')
+    async with async_session() as session:
+        user = (await session.execute(select(User).where(User.username == 'test_user'))).scalar_one()
+
+    async def overwrite(content: bytes) -> None:
+        source, digest, size = blob_store.stage_fileobj(io.BytesIO(content))
+        async with async_session() as session:
+            await file_service.add_file_record(db=session, user_obj=user, path='racedir/testfile_race',
+                                               name='testfile_race', digest=digest, size=size, source=source)
+
+    monkeypatch.setattr(quota_service, 'charge', slow_charge)
+    await asyncio.gather(overwrite(b'first'), overwrite(b'second!'))
+    digests = {content: hashlib.sha256(content).hexdigest() for content in (b'orig', b'first', b'second!')}
+    async with async_session() as session:
+        final = (await session.execute(select(File.digest).where(File.path == 'racedir/testfile_race'))).scalar_one()
+        blobs = dict((await session.execute(select(Blob.digest, Blob.ref_count)
+                                            .where(Blob.digest.in_(digests.values())))).all())
+        user = await session.get(User, user.id)
+        total = (await session.execute(select(func.sum(File.size)).where(File.user_id == user.id))).scalar_one()
+    assert blobs == {digests[b'orig']: 1, final: 1}
+    assert user.used_bytes == total
+
+
+@pytest.mark.asyncio
+async def test_discard_keeps_a_blob_referenced_again(auth_client, monkeypatch):
+    discard = blob_store.discard
+    discarded = []
+
+    async def defer_discard(digest: str) -> None:
+        discarded.append(digest)
+
+    monkeypatch.setattr(blob_store, 'discard', defer_discard)
+    await upload_test_file(auth_client, 'testfile_discard', '/discarddir', content='discarded')
+    await auth_client.delete('/api/v1/files/', params={'path': '/discarddir/testfile_discard'})
+    digest = hashlib.sha256(b'discarded').hexdigest()
+    assert discarded == [digest]
+    charge = quota_service.charge
+
+    async def slow_charge(**kwargs):
+        # the upload holds its reference while the discard of the previous one runs
+        await asyncio.sleep(0.2)
+        await charge(**kwargs)
+
+    async def late_discard() -> None:
+        await asyncio.sleep(0.1)
+        await discard(digest)
+
+    monkeypatch.setattr(quota_service, 'charge', slow_charge)
+    response, _ = await asyncio.gather(
+        upload_test_file(auth_client, 'testfile_discard_again', '/discarddir', content='discarded'), late_discard())
+    assert response.status_code == HTTPStatus.CREATED
+    with open(blob_store.path(digest), 'rb') as stored:
+        assert stored.read() == b'discarded'
+        assert os.fstat(stored.fileno()).st_mode & 0o777 == 0o644
+
+
+@pytest.mark.asyncio
+async def test_storage_quota_and_usage(auth_client, monkeypatch):
+    await auth_client.post('/api/v1/register/', json={'username': 'quota_user', 'password': 'quotapass'})
+    response = await auth_client.post('/api/v1/auth/', json={'username': 'quota_user', 'password': 'quotapass'})
+    auth_client.headers = {'Authorization': 'Bearer ' + response.json()['access_token']}
+    monkeypatch.setattr(settings, 'default_quota_bytes', 1000)
+    response = await upload_test_file(auth_client, 'testfile_quota1', '/quotadir', content='x' * 600)
+    assert response.status_code == HTTPStatus.CREATED
+    response = await upload_test_file(auth_client, 'testfile_quota2', '/quotadir', content='y' * 600)
+    assert response.status_code == HTTPStatus.INSUFFICIENT_STORAGE
+    forms = []
+    form = Request.form
+    monkeypatch.setattr(Request, 'form', lambda self, **kwargs: forms.append(kwargs) or form(self, **kwargs))
+    response = await auth_client.post('/api/v1/files/batch', params={'path': '/quotadir'},
+                                      files=[('files', ('testfile_quota3', b'w' * 600))])
+    assert (response.status_code, forms) == (HTTPStatus.INSUFFICIENT_STORAGE, [])
+    monkeypatch.setattr(Request, 'form', form)
+    response = await auth_client.get('/api/v1/files/usage')
+    assert response.json() == {'used_bytes': 600, 'files_count': 1, 'quota_bytes': 1000}
+    async with async_session() as session:
+        await session.execute(update(User).where(User.username == 'quota_user').values(used_bytes=0))
+        await session.commit()
+        assert await quota_service.reconcile(db=session) >= 1
+    response = await auth_client.get('/api/v1/files/usage')
+    assert response.json()['used_bytes'] == 600
+    rejected = hashlib.sha256(b'y' * 600).hexdigest()
+    assert not os.path.exists(blob_store.path(rejected))
+    assert not [name for _, _, names in os.walk(os.path.join(settings.files_folder, 'blobs'))
+                for name in names if name.startswith('.tmp-')]
+    # overwriting gives the old size back, so only the difference has to fit
+    response = await auth_client.post('/api/v1/files/uploads/', json={'path': '/quotadir/testfile_quota1',
+                                                                      'size': 900})
+    assert response.status_code == HTTPStatus.CREATED
+    response = await upload_test_file(auth_client, 'testfile_quota1', '/quotadir/testfile_quota1', content='z' * 700)
+    assert response.status_code == HTTPStatus.CREATED
+    response = await auth_client.get('/api/v1/files/usage')
+    assert response.json()['used_bytes'] == 700
+    response = await auth_client.delete('/api/v1/files/', params={'path': '/quotadir/testfile_quota1'})
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    response = await auth_client.get('/api/v1/files/usage')
+    assert (response.json()['used_bytes'], response.json()['files_count']) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_metrics(auth_client):
+    await upload_test_file(auth_client, 'testfile_metrics', '/metricsdir')
+    await auth_client.get('/api/v1/files/download', params={'path': '/metricsdir', 'compression': 'zip'})
+    response = await auth_client.get('/api/v1/metrics/')
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['content-type'].startswith('text/plain')
+    text = response.text
+    labels = 'method="POST",route="/api/v1/files/upload",status="201"'
+    assert f'http_requests_total{{{labels}}}' in text
+    assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}' in text
+    assert 'archive_build_duration_seconds_count{codec="zip"}' in text
+    assert 'db_pool_checked_out ' in text
+    assert 'user_cache_hits_total ' in text
+
+
+@pytest.mark.asyncio
+async def test_ping_reports_probes_and_degrades(client, monkeypatch):
+    monkeypatch.setattr(settings, 'download_mode', 'stream')
+    response = await client.get('/api/v1/ping/')
+    assert response.status_code == HTTPStatus.OK
+    result = response.json()
+    assert result['status'] == 'ok'
+    assert {'db', 'storage', 'pool', 'loop', 'static'} <= result.keys()
+    assert result['storage']['free_bytes'] > 0
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(settings, 'ping_probe_timeout_seconds', 0.1)
+    monkeypatch.setattr('src.api.v1.ping.probe_static', hang)
+    response = await client.get('/api/v1/ping/')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['status'] == 'degraded'
+    assert 'static' in response.json()['errors']
+
+
+@pytest.mark.asyncio
+async def test_download_returns_db_connection_before_streaming(auth_client, monkeypatch):
+    await upload_test_file(auth_client, 'testfile_pool', '/pooldir')
+    checked_out = []
+
+    class RecordingResponse(StreamingResponse):
+        async def __call__(self, scope, receive, send):
+            checked_out.append(pool_stats()['checked_out'])
+            await super().__call__(scope, receive, send)
+
+    monkeypatch.setattr('src.api.v1.files.StreamingResponse', RecordingResponse)
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/pooldir', 'compression': 'tar'})
+    assert response.status_code == HTTPStatus.OK
+    assert checked_out == [0]
+
+
+def test_cancelled_producer_does_not_block_on_a_full_channel():
+    channel = queue.Queue(1)
+    channel.put(b'unread')
+    cancelled = threading.Event()
+
+    def failing():
+        yield from ()
+        raise ValueError('broken')
+
+    for produce in (lambda: iter(()), failing):
+        producer = threading.Thread(target=_produce, args=(produce, (), channel, cancelled), daemon=True)
+        producer.start()
+        cancelled.set()
+        producer.join(timeout=5)
+        assert not producer.is_alive()
+        cancelled.clear()
+
+
+def test_log_rate_limit_and_sampling():
+    rate_limit = RateLimitFilter(rate=2)
+    records = [logging.LogRecord('hot', logging.INFO, 'hot.py', 1, 'hit', None, None) for _ in range(5)]
+    assert [rate_limit.filter(record) for record in records] == [True, True, False, False, False]
+    assert rate_limit.filter(logging.LogRecord('hot', logging.ERROR, 'hot.py', 1, 'fail', None, None))
+    sampler = LogSampler(first=2, every=10)
+    assert sum(sampler() for _ in range(100)) == 12
+    assert json.loads(JsonFormatter().format(records[0]))['message'] == 'hit'
+
+
+@pytest.mark.asyncio
+async def test_relayout_legacy_files(auth_client, monkeypatch):
+    assert StorageLayout(depth=3, width=1).relative_path('abcdef') == os.path.join('a', 'b', 'c', 'abcdef')
+    await upload_test_file(auth_client, 'testfile_legacy_owner', '/legacydir')
+    legacy_path = os.path.join(settings.files_folder, 'legacydir', 'old.txt')
+    os.makedirs(os.path.dirname(legacy_path), exist_ok=True)
+    with open(legacy_path, 'w') as f:
+        f.write('legacy')
+    async with async_session() as session:
+        owner = (await session.execute(select(File.user_id).where(File.path == 'legacydir/testfile_legacy_owner')))
+        session.add(File(user_id=owner.scalar_one(), name='old.txt', path='legacydir/old.txt', parent='legacydir',
+                         size=6, is_downloadable=True))
+        await session.commit()
+        assert await migrate_legacy(session, batch_size=1, grace_seconds=0) == 1
+    assert not os.path.exists(legacy_path)
+    monkeypatch.setattr(settings, 'download_mode', 'stream')
+    response = await auth_client.get('/api/v1/files/download', params={'path': '/legacydir/old.txt'})
+    assert response.content == b'legacy'
+    assert response.headers['ETag'] == '"' + hashlib.sha256(b'legacy').hexdigest() + '"'
+    # a blob written under the previous layout after the link pass is linked before its old path goes
+    digest = hashlib.sha256(b'legacy').hexdigest()
+    previous = StorageLayout(depth=1, width=2)
+    old_path = os.path.join(blob_store.root, blob_store.relative_path(digest, previous))
+    os.makedirs(os.path.dirname(old_path), exist_ok=True)
+    os.replace(blob_store.path(digest), old_path)
+    async with async_session() as session:
+        assert await relayout_blobs(session, previous, cleanup=True, batch_size=100) >= 1
+    assert not os.path.exists(old_path)
+    with open(blob_store.path(digest), 'rb') as stored:
+        assert stored.read() == b'legacy'
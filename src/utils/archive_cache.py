@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from typing import Any, AsyncIterator, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from src.core import settings
+from src.core.logger import logger
+
+
+def _fingerprint(target: str, compress_type: str, entries: list[tuple[str, str]]) -> str:
+    digest = hashlib.sha256(f'{target}\0{compress_type}'.encode())
+    for filepath, arcname in sorted(entries, key=lambda entry: entry[1]):
+        try:
+            stat = os.stat(filepath)
+            digest.update(f'\0{arcname}\0{filepath}\0{stat.st_size}\0{stat.st_mtime_ns}'.encode())
+        except FileNotFoundError:
+            digest.update(f'\0{arcname}\0{filepath}\0missing'.encode())
+    return digest.hexdigest()
+
+
+class CachingStream:
+    """Streams a compression job to the client and writes the same bytes into the cache."""
+
+    def __init__(self, cache: 'ArchiveCache', key: str, extension: str, job: Any):
+        self._cache = cache
+        self._key = key
+        self._extension = extension
+        self._job = job
+        self._closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache.folder, prefix='.tmp-')
+        stored = False
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                async for chunk in self._job:
+                    await run_in_threadpool(tmp.write, chunk)
+                    yield chunk
+            await self._cache.store(tmp_path, self._key, self._extension)
+            stored = True
+        finally:
+            if not stored:
+                os.unlink(tmp_path)
+            self.close()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._job.close()
+        self._cache.release(self._key)
+
+
+class ArchiveCache:
+    """Size bounded LRU of built archives on disk, keyed by the content fingerprint of the archived files.
+
+    Concurrent requests for the same key are single-flighted: one builds, the others wait and read the result.
+    """
+
+    def __init__(self, root: str, folder_name: str, max_bytes: int, stale_tmp_seconds: int, min_age_seconds: int):
+        self.root = root
+        self.folder_name = folder_name
+        self.folder = os.path.join(root, folder_name)
+        self.max_bytes = max_bytes
+        self.stale_tmp_seconds = stale_tmp_seconds
+        self.min_age_seconds = min_age_seconds
+        self._flights: dict[str, asyncio.Event] = {}
+
+    def relative_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.folder_name, f'{key}.{extension}')
+
+    async def make_key(self, target: str, compress_type: str, entries: list[tuple[str, str]]) -> str:
+        return await run_in_threadpool(_fingerprint, target, compress_type, entries)
+
+    async def get(self, key: str, extension: str) -> Optional[str]:
+        """Returns the relative path of a cached archive and marks it as recently used."""
+        relative_path = self.relative_path(key, extension)
+        try:
+            # mtime is the LRU clock
+            await run_in_threadpool(os.utime, os.path.join(self.root, relative_path))
+        except FileNotFoundError:
+            return None
+        return relative_path
+
+    async def acquire(self, key: str, extension: str) -> Optional[str]:
+        """Returns a cached archive, or None when the caller has to build it and call release() afterwards."""
+        while True:
+            relative_path = await self.get(key, extension)
+            if relative_path:
+                logger.info(f'Archive cache hit {key}')
+                return relative_path
+            flight = self._flights.get(key)
+            if flight is None:
+                self._flights[key] = asyncio.Event()
+                return None
+            await flight.wait()
+
+    def release(self, key: str) -> None:
+        flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.set()
+
+    def stream(self, key: str, extension: str, job: Any) -> CachingStream:
+        os.makedirs(self.folder, exist_ok=True)
+        return CachingStream(self, key, extension, job)
+
+    async def store(self, tmp_path: str, key: str, extension: str) -> None:
+        await run_in_threadpool(os.replace, tmp_path, os.path.join(self.root, self.relative_path(key, extension)))
+        await run_in_threadpool(self._evict)
+
+    async def sweep(self) -> None:
+        """Evicts down to max_bytes and removes temp files of crashed builds, e.g. at startup."""
+        await run_in_threadpool(self._evict)
+
+    def _evict(self) -> None:
+        entries = []
+        # a running build writes its temp file with every chunk, so an old mtime means nobody owns it
+        stale_before = time.time() - self.stale_tmp_seconds
+        try:
+            with os.scandir(self.folder) as scan:
+                for entry in scan:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if not entry.name.startswith('.tmp-'):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    elif stat.st_mtime < stale_before:
+                        self._unlink(entry.path, 'Remove stale archive build')
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in entries)
+        # get() touches an archive before it is served, nginx or the response opens it within min_age_seconds
+        served_after = time.time() - self.min_age_seconds
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes or mtime > served_after:
+                break
+            self._unlink(path, 'Evict archive')
+            total -= size
+
+    @staticmethod
+    def _unlink(path: str, message: str) -> None:
+        try:
+            os.unlink(path)
+            logger.info(f'{message} {path}')
+        except FileNotFoundError:
+            pass
+
+
+archive_cache = ArchiveCache(settings.files_folder, settings.archive_cache_folder_name,
+                             settings.archive_cache_max_bytes, settings.archive_cache_stale_tmp_seconds,
+                             settings.archive_cache_min_age_seconds)
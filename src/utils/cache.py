@@ -0,0 +1,97 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from src.core.logger import logger
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+class TTLCache:
+    """Bounded in-process cache, least recently used entries are evicted first."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    async def set(self, key: str, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def invalidate(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {'backend': 'memory', 'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class RedisCache:
+    """Cache shared by all workers; values are serialized with dumps/loads, eviction is left to redis."""
+
+    def __init__(self, url: str, ttl: float, namespace: str, dumps: Callable[[Any], str],
+                 loads: Callable[[str], Any]):
+        self.ttl = ttl
+        self.namespace = namespace
+        self._dumps = dumps
+        self._loads = loads
+        self._client = aioredis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key: str) -> str:
+        return f'{self.namespace}:{key}'
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self._client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._loads(value)
+
+    async def set(self, key: str, value: Any) -> None:
+        await self._client.set(self._key(key), self._dumps(value), px=int(self.ttl * 1000))
+
+    async def invalidate(self, key: str) -> None:
+        await self._client.delete(self._key(key))
+
+    async def clear(self) -> None:
+        async for key in self._client.scan_iter(match=self._key('*')):
+            await self._client.delete(key)
+
+    def stats(self) -> dict:
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(maxsize: int, ttl: float, url: Optional[str], namespace: str, dumps: Callable[[Any], str],
+               loads: Callable[[str], Any]) -> TTLCache | RedisCache:
+    if url:
+        if aioredis is not None:
+            return RedisCache(url=url, ttl=ttl, namespace=namespace, dumps=dumps, loads=loads)
+        logger.warning('redis package is not installed, fall back to in-process cache')
+    return TTLCache(maxsize=maxsize, ttl=ttl)
@@ -0,0 +1,70 @@
+"""Content-defined chunking with a gear rolling hash (FastCDC style).
+
+Boundaries depend on the bytes around them, not on offsets, so an insert or delete in a large
+file only changes the chunks it touches. Clients chunk a file with chunk_manifest() before a
+delta upload; the server does not care how boundaries were chosen, it only checks the digests.
+"""
+import hashlib
+from typing import BinaryIO, Iterator
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+
+_MASK64 = (1 << 64) - 1
+# fixed pseudo random values, the same on every machine
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'big') for value in range(256))
+
+
+def _mask(bits: int) -> int:
+    # the high bits of the gear hash depend on the last 64 bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def find_boundary(data: bytes, min_size: int, avg_size: int, max_size: int) -> int:
+    """Length of the first chunk of data; data holds max_size bytes unless it is the tail of the file.
+
+    Normalized chunking: a stricter mask before avg_size and a looser one after it keep chunk sizes
+    close to avg_size.
+    """
+    length = min(len(data), max_size)
+    if length <= min_size:
+        return length
+    bits = avg_size.bit_length() - 1
+    strict, loose = _mask(bits + 1), _mask(bits - 1)
+    gear = GEAR
+    value = 0
+    normal = min(avg_size, length)
+    for index in range(min_size, normal):
+        value = ((value << 1) + gear[data[index]]) & _MASK64
+        if not value & strict:
+            return index + 1
+    for index in range(normal, length):
+        value = ((value << 1) + gear[data[index]]) & _MASK64
+        if not value & loose:
+            return index + 1
+    return length
+
+
+def iter_chunks(fileobj: BinaryIO, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE,
+                max_size: int = MAX_SIZE) -> Iterator[bytes]:
+    buffer = b''
+    eof = False
+    while True:
+        if not eof and len(buffer) < max_size:
+            data = fileobj.read(max_size)
+            eof = not data
+            buffer += data
+            continue
+        if not buffer:
+            return
+        size = find_boundary(buffer, min_size, avg_size, max_size)
+        yield buffer[:size]
+        buffer = buffer[size:]
+
+
+def chunk_manifest(fileobj: BinaryIO, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE,
+                   max_size: int = MAX_SIZE) -> list[dict]:
+    """[{"digest": sha256 hex, "size": ...}, ...] in file order, the body of a delta upload."""
+    return [{'digest': hashlib.sha256(chunk).hexdigest(), 'size': len(chunk)}
+            for chunk in iter_chunks(fileobj, min_size, avg_size, max_size)]
@@ -0,0 +1,158 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+from src.core import settings
+from src.core.logger import logger
+from src.utils.metrics import archive_build_duration
+
+_END = None
+_POLL_INTERVAL = 0.5
+
+
+def _put(channel: Any, item: Any, cancelled: Any) -> bool:
+    """Puts into the bounded channel unless the job got cancelled while it was full."""
+    while not cancelled.is_set():
+        try:
+            channel.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce(func: Callable[..., Iterator[bytes]], args: tuple, channel: Any, cancelled: Any) -> None:
+    """Runs inside a pool worker and pushes chunks into the bounded channel."""
+    try:
+        for chunk in func(*args):
+            if not _put(channel, chunk, cancelled):
+                return
+    except Exception as exc:
+        _put(channel, RuntimeError(f'{type(exc).__name__}: {exc}'), cancelled)
+        return
+    _put(channel, _END, cancelled)
+
+
+class CompressionJob:
+    def __init__(self, executor: 'CompressionExecutor', channel: Any, cancelled: Any, label: str = ''):
+        self._executor = executor
+        self._channel = channel
+        self._cancelled = cancelled
+        self._closed = False
+        self._started = time.perf_counter()
+        self.label = label
+        self.future: Optional[asyncio.Future] = None
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    item = await loop.run_in_executor(None, self._channel.get, True, _POLL_INTERVAL)
+                except queue.Empty:
+                    if self.future is not None and self.future.done() and self.future.exception():
+                        raise self.future.exception()
+                    continue
+                if item is _END:
+                    archive_build_duration.observe(time.perf_counter() - self._started, (self.label,))
+                    break
+                if isinstance(item, Exception):
+                    logger.error(f'Compression job failed: {item}')
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Cancels the worker (e.g. on client disconnect) and frees the job slot, idempotent."""
+        if self._closed:
+            return
+        self._closed = True
+        self._cancelled.set()
+        self._executor.release()
+
+
+class CompressionExecutor:
+    def __init__(self, kind: str, max_workers: int, max_jobs: int, queue_size: int, wait_timeout: float,
+                 mp_context: str):
+        self.kind = kind
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.wait_timeout = wait_timeout
+        self._mp_context = mp_context
+        self._slots = asyncio.Semaphore(max_jobs)
+        self._pool: Optional[Executor] = None
+        self._manager = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> Executor:
+        with self._lock:
+            if self._pool is None:
+                if self.kind == 'process':
+                    try:
+                        context = multiprocessing.get_context(self._mp_context)
+                        self._manager = context.Manager()
+                        self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+                    except (OSError, EOFError, NotImplementedError, ValueError) as exc:
+                        logger.warning(f'Process pool is not available ({exc}), fall back to threads')
+                        self.kind = 'thread'
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='compression')
+            return self._pool
+
+    def _make_channel(self) -> tuple[Executor, Any, Any]:
+        pool = self._get_pool()
+        if self._manager is not None:
+            return pool, self._manager.Queue(self.queue_size), self._manager.Event()
+        return pool, queue.Queue(self.queue_size), threading.Event()
+
+    async def submit(self, func: Callable[..., Iterator[bytes]], *args: Any, label: str = '') -> CompressionJob:
+        """Reserves a job slot and starts producing chunks of func(*args) in the pool.
+
+        label names the job in metrics, e.g. the archive codec.
+        """
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.wait_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Too many compression jobs, try again later.'
+            )
+        loop = asyncio.get_running_loop()
+        try:
+            pool, channel, cancelled = await loop.run_in_executor(None, self._make_channel)
+        except BaseException:
+            self.release()
+            raise
+        job = CompressionJob(self, channel, cancelled, label)
+        job.future = loop.run_in_executor(pool, _produce, func, args, channel, cancelled)
+        return job
+
+    def release(self) -> None:
+        self._slots.release()
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+compression_executor = CompressionExecutor(
+    kind=settings.compression_executor,
+    max_workers=settings.compression_workers,
+    max_jobs=settings.compression_max_jobs,
+    queue_size=settings.compression_queue_size,
+    wait_timeout=settings.compression_wait_timeout,
+    mp_context=settings.compression_mp_context,
+)
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Awaitable, Callable
+
+import httpx
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from src.core import settings
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+async def probe_db(session: AsyncSession) -> float:
+    started = time.perf_counter()
+    await session.execute(text('SELECT 1'))
+    return _ms(time.perf_counter() - started)
+
+
+def _probe_storage(folder: str) -> dict:
+    os.makedirs(folder, exist_ok=True)
+    payload = os.urandom(4096)
+    started = time.perf_counter()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.ping-')
+    try:
+        os.write(fd, payload)
+        written = time.perf_counter()
+        os.fsync(fd)
+        synced = time.perf_counter()
+        if os.pread(fd, len(payload), 0) != payload:
+            raise OSError('Read back data differs from written data')
+        done = time.perf_counter()
+    finally:
+        os.close(fd)
+        os.unlink(tmp_path)
+    return {'write': _ms(written - started), 'fsync': _ms(synced - written), 'read': _ms(done - synced),
+            'free_bytes': shutil.disk_usage(folder).free}
+
+
+async def probe_storage() -> dict:
+    return await run_in_threadpool(_probe_storage, settings.files_folder)
+
+
+async def probe_pool(stats: Callable[[], dict]) -> dict:
+    return stats()
+
+
+async def probe_loop() -> dict:
+    """Time between scheduling a callback and the loop running it."""
+    loop = asyncio.get_running_loop()
+    woke = loop.create_future()
+    started = time.perf_counter()
+    loop.call_soon(woke.set_result, None)
+    await woke
+    return {'lag': _ms(time.perf_counter() - started)}
+
+
+async def probe_static() -> dict:
+    if settings.download_mode != 'redirect':
+        return {'skipped': f'download_mode is {settings.download_mode}'}
+    async with httpx.AsyncClient(timeout=settings.ping_probe_timeout_seconds) as client:
+        started = time.perf_counter()
+        response = await client.head(settings.static_url + '/')
+        # any HTTP answer means the static server is reachable
+        return {'latency': _ms(time.perf_counter() - started), 'status': response.status_code}
+
+
+async def run_probes(probes: dict[str, Awaitable], timeout: float) -> tuple[dict, dict]:
+    """Runs probes concurrently, each bounded by timeout; returns (results, errors by probe name)."""
+
+    async def bounded(probe: Awaitable) -> Any:
+        return await asyncio.wait_for(probe, timeout=timeout)
+
+    outcomes = await asyncio.gather(*(bounded(probe) for probe in probes.values()), return_exceptions=True)
+    results, errors = {}, {}
+    for name, outcome in zip(probes, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            errors[name] = f'Timed out after {timeout} s'
+        elif isinstance(outcome, BaseException):
+            errors[name] = f'{type(outcome).__name__}: {outcome}'
+        else:
+            results[name] = outcome
+    return results, errors
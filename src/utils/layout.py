@@ -0,0 +1,24 @@
+import os
+
+
+class StorageLayout:
+    """Maps an object key (hex digest or uuid) to a fan-out path like ab/cd/<key>.
+
+    depth directory levels of width characters each keep every directory small,
+    whatever the logical paths of the stored files are.
+    """
+
+    def __init__(self, depth: int = 2, width: int = 2):
+        self.depth = depth
+        self.width = width
+
+    def relative_path(self, key: str) -> str:
+        name = key.replace('-', '')
+        levels = [name[level * self.width:(level + 1) * self.width] for level in range(self.depth)]
+        return os.path.join(*levels, key)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, StorageLayout) and (self.depth, self.width) == (other.depth, other.width)
+
+    def __repr__(self) -> str:
+        return f'StorageLayout(depth={self.depth}, width={self.width})'
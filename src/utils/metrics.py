@@ -0,0 +1,228 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+THROUGHPUT_BUCKETS = tuple(2 ** power * 1024 * 1024 for power in range(-2, 11))  # 256 KiB/s .. 1 GiB/s
+THROUGHPUT_MIN_BYTES = 64 * 1024
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """Values live in a plain dict keyed by the label values tuple.
+
+    Updates happen on the event loop thread only, so they need no lock; a sample costs one dict lookup.
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labelnames, values, value in self.samples():
+            lines.append(f'{name}{_format_labels(labelnames, values)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Incremented explicitly, or read from callback at scrape time."""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._callback = callback
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        if self._callback is not None:
+            yield self.name, self.labelnames, (), self._callback()
+            return
+        for labels, value in list(self._values.items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge(Metric):
+    """Set explicitly, or read from callback at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._callback = callback
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        self._values[labels] = value
+
+    def samples(self):
+        if self._callback is not None:
+            yield self.name, self.labelnames, (), self._callback()
+            return
+        for labels, value in list(self._values.items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: [count per bucket..., count in +Inf, sum]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        labelnames = self.labelnames + ('le',)
+        for labels, counts in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', labelnames, labels + (bound,), cumulative
+            yield f'{self.name}_count', self.labelnames, labels, cumulative
+            yield f'{self.name}_sum', self.labelnames, labels, counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'http_requests_total', 'HTTP requests by route and status.', ('method', 'route', 'status')))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route and status.', ('method', 'route', 'status')))
+http_received_bytes = registry.register(Counter(
+    'http_received_bytes_total', 'Request body bytes by route.', ('route',)))
+http_sent_bytes = registry.register(Counter(
+    'http_sent_bytes_total', 'Response body bytes by route.', ('route',)))
+transfer_throughput = registry.register(Histogram(
+    'file_transfer_throughput_bytes_per_second', 'Throughput of uploads and downloads.', ('direction',),
+    buckets=THROUGHPUT_BUCKETS))
+archive_build_duration = registry.register(Histogram(
+    'archive_build_duration_seconds', 'Time to build and stream an archive by codec.', ('codec',),
+    buckets=LATENCY_BUCKETS + (60.0, 120.0, 300.0)))
+event_loop_lag = registry.register(Gauge(
+    'event_loop_lag_seconds', 'Delay of the last event loop wake up behind schedule.'))
+event_loop_lag_histogram = registry.register(Histogram(
+    'event_loop_lag_distribution_seconds', 'Event loop wake up delays.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)))
+
+
+def register_pool_gauges(stats: Callable[[], dict]) -> None:
+    """Exports the DB pool statistics; stats() is called at scrape time."""
+    for key, documentation in (('size', 'Configured pool size.'), ('checked_out', 'Connections in use.'),
+                               ('checked_in', 'Idle connections.'), ('overflow', 'Connections above pool size.'),
+                               ('saturation', 'Checked out share of pool size plus max overflow.')):
+        registry.register(Gauge(f'db_pool_{key}', documentation, callback=lambda key=key: stats()[key] or 0))
+    for key, documentation in (('connects', 'New DB connections opened.'), ('checkouts', 'Pool checkouts.'),
+                               ('invalidations', 'Connections invalidated after errors.')):
+        registry.register(Counter(f'db_pool_{key}_total', documentation, callback=lambda key=key: stats()[key]))
+
+
+def register_cache_metrics(prefix: str, stats: Callable[[], dict]) -> None:
+    """Exports the counters of a TTLCache or RedisCache; stats() is called at scrape time."""
+    for key in ('hits', 'misses', 'evictions'):
+        registry.register(Counter(f'{prefix}_{key}_total', f'Cache {key}.',
+                                  callback=lambda key=key: stats().get(key, 0)))
+    registry.register(Gauge(f'{prefix}_size', 'Entries in the in-process cache.',
+                            callback=lambda: stats().get('size', 0)))
+
+
+async def watch_event_loop_lag(interval: float) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - started - interval, 0.0)
+        event_loop_lag.set(lag)
+        event_loop_lag_histogram.observe(lag)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: counts requests, latency and body bytes per route template."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        received = 0
+        sent = 0
+        status_code = 500
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            received += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message: Message) -> None:
+            nonlocal sent, status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            elif message['type'] == 'http.response.zerocopysend':
+                sent += message.get('count') or 0
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = scope.get('route')
+            # route templates keep the label cardinality bounded
+            route = getattr(route, 'path', '<unmatched>')
+            labels = (scope['method'], route, status_code)
+            http_requests.inc(labels)
+            http_request_duration.observe(elapsed, labels)
+            if received:
+                http_received_bytes.inc((route,), received)
+                if received >= THROUGHPUT_MIN_BYTES:
+                    transfer_throughput.observe(received / elapsed, ('upload',))
+            if sent:
+                http_sent_bytes.inc((route,), sent)
+                if sent >= THROUGHPUT_MIN_BYTES:
+                    transfer_throughput.observe(sent / elapsed, ('download',))
@@ -0,0 +1,96 @@
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette import status
+from starlette.datastructures import Headers
+
+
+def _decode(value: bytes) -> str:
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+class MultipartFileStream:
+    """Yields the bytes of one file field straight from a multipart/form-data request stream.
+
+    Nothing is spooled: each chunk the parser emits is handed on as it arrives, other fields are skipped.
+    filename is set once the part headers of the field have been parsed, before its first chunk.
+    """
+
+    def __init__(self, headers: Headers, stream: AsyncIterator[bytes], field_name: str = 'file'):
+        content_type, params = parse_options_header(headers.get('content-type', ''))
+        if content_type != b'multipart/form-data' or b'boundary' not in params:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail='Expected multipart/form-data with a boundary.'
+            )
+        self.boundary = params[b'boundary']
+        self.field_name = field_name
+        self.filename: Optional[str] = None
+        self._stream = stream
+        self._chunks: list[bytes] = []
+        self._headers: dict[bytes, bytes] = {}
+        self._header_field = b''
+        self._header_value = b''
+        self._in_field = False
+        self._finished = False
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        self._in_field = (self.filename is None and b'filename' in options
+                          and _decode(options.get(b'name', b'')) == self.field_name)
+        if self._in_field:
+            self.filename = _decode(options[b'filename'])
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_field:
+            self._chunks.append(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._in_field:
+            self._in_field = False
+            self._finished = True
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        parser = MultipartParser(self.boundary, {
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        })
+        async for chunk in self._stream:
+            parser.write(chunk)
+            chunks, self._chunks = self._chunks, []
+            for data in chunks:
+                yield data
+            if self._finished:
+                return
+        if self.filename is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Field "{self.field_name}" with a file is required.'
+            )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Request body ended in the middle of the file.'
+        )
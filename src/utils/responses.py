@@ -0,0 +1,185 @@
+import os
+import re
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional
+from uuid import uuid4
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from src.core import settings
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+# more ranges than this are ignored, a client asking for many small ranges makes us seek for each one
+MAX_RANGES = 16
+
+
+def parse_range(range_header: str, size: int) -> Optional[list[tuple[int, int]]]:
+    """Parses a "bytes=" Range header into inclusive (start, end) pairs, sorted with overlapping and
+    adjacent ranges merged.
+
+    Returns None when the header should be ignored (also above MAX_RANGES ranges) and an empty list
+    when no range is satisfiable.
+    """
+    unit, _, ranges_spec = range_header.partition('=')
+    parts = ranges_spec.split(',')
+    if unit.strip().lower() != 'bytes' or not ranges_spec or len(parts) > MAX_RANGES:
+        return None
+    ranges = []
+    for part in parts:
+        match = RANGE_RE.match(part)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size:
+            ranges.append((start, end))
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = merged[-1][0], max(merged[-1][1], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def utc_timestamp(value: datetime) -> float:
+    """Timestamp of a naive UTC datetime as stored in the models."""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def is_not_modified(headers: Mapping[str, str], etag: str, last_modified: Optional[float] = None) -> bool:
+    """Evaluates If-None-Match (weak comparison) or, without it, If-Modified-Since for a GET."""
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return etag.removeprefix('W/') in tags
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def validator_headers(etag: str, last_modified: Optional[float] = None) -> dict[str, str]:
+    headers = {'etag': etag}
+    if last_modified is not None:
+        headers['last-modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def not_modified_response(etag: str, last_modified: Optional[float] = None,
+                          headers: Optional[Mapping[str, str]] = None) -> Response:
+    return Response(status_code=304, headers={**validator_headers(etag, last_modified), **(headers or {})})
+
+
+class RangeFileResponse(Response):
+    """Streams a file from disk with Range/If-Range support and constant memory.
+
+    Uses the ASGI zerocopysend extension (sendfile) when the server provides it,
+    otherwise reads chunk_size aligned blocks with pread in a worker thread.
+    """
+
+    def __init__(self, path: str, media_type: str, etag: str,
+                 range_header: Optional[str] = None, if_range: Optional[str] = None,
+                 headers: Optional[Mapping[str, str]] = None, chunk_size: Optional[int] = None,
+                 last_modified: Optional[float] = None):
+        self.path = path
+        self.chunk_size = chunk_size or settings.download_chunk_size
+        self.media_type = media_type
+        self.background = None
+        stat = os.stat(path)
+        self.size = stat.st_size
+        mtime = stat.st_mtime if last_modified is None else last_modified
+        self.init_headers(headers)
+        self.headers.setdefault('accept-ranges', 'bytes')
+        for key, value in validator_headers(etag, mtime).items():
+            self.headers.setdefault(key, value)
+        self.ranges: list[tuple[int, int]] = [(0, self.size - 1)] if self.size else []
+        self.status_code = 200
+        self.boundary = None
+        if range_header and self._if_range_matches(if_range, etag, mtime):
+            ranges = parse_range(range_header, self.size)
+            if ranges == []:
+                self.status_code = 416
+                self.ranges = []
+                self.headers['content-range'] = f'bytes */{self.size}'
+                self.headers['content-length'] = '0'
+                return
+            if ranges:
+                self.status_code = 206
+                self.ranges = ranges
+        if self.status_code == 206 and len(self.ranges) > 1:
+            self.boundary = uuid4().hex
+            self.headers['content-type'] = f'multipart/byteranges; boundary={self.boundary}'
+            self.headers['content-length'] = str(sum(len(self._part_header(start, end)) + end - start + 1
+                                                     for start, end in self.ranges) + len(self._closing()))
+        else:
+            if self.status_code == 206:
+                start, end = self.ranges[0]
+                self.headers['content-range'] = f'bytes {start}-{end}/{self.size}'
+            self.headers['content-length'] = str(sum(end - start + 1 for start, end in self.ranges))
+
+    @staticmethod
+    def _if_range_matches(if_range: Optional[str], etag: str, mtime: float) -> bool:
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag and not etag.startswith('W/')
+        # an HTTP-date validates only when it is exactly Last-Modified, never a later date
+        try:
+            return int(parsedate_to_datetime(if_range).timestamp()) == int(mtime)
+        except (TypeError, ValueError):
+            return False
+
+    def _part_header(self, start: int, end: int) -> bytes:
+        return (f'\r\n--{self.boundary}\r\nContent-Type: {self.media_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n').encode('latin-1')
+
+    def _closing(self) -> bytes:
+        return f'\r\n--{self.boundary}--\r\n'.encode('latin-1')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD' or not self.ranges:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        zero_copy = 'http.response.zerocopysend' in scope.get('extensions', {})
+        with open(self.path, 'rb') as file:
+            for start, end in self.ranges:
+                if self.boundary:
+                    await send({'type': 'http.response.body', 'body': self._part_header(start, end),
+                                'more_body': True})
+                if zero_copy:
+                    await send({'type': 'http.response.zerocopysend', 'file': file, 'offset': start,
+                                'count': end - start + 1, 'more_body': True})
+                else:
+                    await self._send_range(file.fileno(), start, end, send)
+        closing = self._closing() if self.boundary else b''
+        await send({'type': 'http.response.body', 'body': closing, 'more_body': False})
+
+    async def _send_range(self, fd: int, start: int, end: int, send: Send) -> None:
+        position = start
+        while position <= end:
+            # keep reads aligned to chunk_size so the page cache is hit in whole blocks
+            count = min(self.chunk_size - position % self.chunk_size, end - position + 1)
+            data = await run_in_threadpool(os.pread, fd, count, position)
+            if not data:
+                break
+            position += len(data)
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
@@ -1,25 +1,38 @@
+import asyncio
 import datetime
+import errno
+import gzip
+import hashlib
 import os
 import io
 import tarfile
+import tempfile
 import zipfile
-from os.path import basename
+import zlib
+from urllib.parse import quote
 from uuid import UUID
 
 import py7zr
+import pyzstd
 from datetime import datetime, timedelta
-from typing import Callable
-from aioshutil import copyfileobj
-from fastapi import File as FileObj
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterable, AsyncIterator, BinaryIO, Callable, Iterable, Iterator, Optional
+from fastapi import HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from passlib.context import CryptContext
+from starlette import status
+from starlette.concurrency import run_in_threadpool
 
 from src.core import settings
-from src.core.logger import logger
+from src.core.logger import LogSampler, logger
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+password_executor = ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix='bcrypt')
+password_slots = asyncio.Semaphore(settings.password_hash_max_pending)
+# mkstemp creates 0600 files; stored files are served by nginx, which runs as another user
+FILE_MODE = 0o644
 
 
 def verify_password(plain_password, hashed_password):
@@ -30,6 +43,29 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+async def _run_password_job(func: Callable, *args: Any) -> Any:
+    """Runs bcrypt in its own bounded pool so a login storm can not starve the event loop or default executor."""
+    try:
+        await asyncio.wait_for(password_slots.acquire(), timeout=settings.password_hash_wait_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Too many authentication requests, try again later.'
+        )
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_slots.release()
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await _run_password_job(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password) -> str:
+    return await _run_password_job(get_password_hash, password)
+
+
 def create_access_token(id_: str):
     expire = datetime.utcnow() + timedelta(
         minutes=settings.access_token_expire_minutes
@@ -39,47 +75,283 @@ def create_access_token(id_: str):
     return encoded_jwt
 
 
-async def write_file(file_obj: FileObj, full_file_path: str):
-    with open(full_file_path, 'wb') as file:
-        await copyfileobj(file_obj.file, file)
-
-
-def add_to_arch(write_to_arch: Callable, full_path: str) -> None:
-    if os.path.isfile(full_path):
-        logger.info(f'Add to archive file {full_path}')
-        write_to_arch(full_path, basename(full_path))
-    else:
-        logger.info(f'Add to archive folder {full_path}')
-        try:
-            for dirpath, dirnames, filenames in os.walk(full_path):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    logger.info(f'Add to archive {filepath}')
-                    write_to_arch(filepath)
-        except FileNotFoundError:
-            logger.error(f'Error add to arch file not found')
-
-
-def archive_file(compress_type: str, full_path: str) -> tuple[io.BytesIO, str, str]:
-    app_type = None
-    arch_name = f'archive_{datetime.now().timestamp()}.{compress_type}'
-    arch_buffer = io.BytesIO()
-    match compress_type:
-        case "zip":
-            with zipfile.ZipFile(arch_buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_io:
-                add_to_arch(write_to_arch=zip_io.write, full_path=full_path)
-                zip_io.close()
-            app_type = 'application/x-zip-compressed'
-        case "tar":
-            with tarfile.open(fileobj=arch_buffer, mode='w:gz') as tar:
-                add_to_arch(write_to_arch=tar.add, full_path=full_path)
-                tar.close()
-            app_type = 'application/x-gtar'
-        case "7z":
-            with py7zr.SevenZipFile(arch_buffer, 'w') as seven_zip:
-                add_to_arch(write_to_arch=seven_zip.write, full_path=full_path)
-            app_type = 'application/x-7z-compressed'
-    return arch_buffer, app_type, arch_name
+def hash_fileobj(fileobj: BinaryIO, chunk_size: int) -> tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    while chunk := fileobj.read(chunk_size):
+        digest.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest(), size
+
+
+def hash_path(full_file_path: str, chunk_size: int) -> tuple[str, int]:
+    with open(full_file_path, 'rb') as fileobj:
+        return hash_fileobj(fileobj, chunk_size)
+
+
+def copy_fileobj_hashed(fileobj: BinaryIO, directory: str, chunk_size: int) -> tuple[str, str, int]:
+    """Copies fileobj into a temp file in directory, hashing in the same pass; returns (tmp_path, digest, size)."""
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, 'wb') as dest:
+            while chunk := fileobj.read(chunk_size):
+                digest.update(chunk)
+                size += len(chunk)
+                dest.write(chunk)
+            dest.flush()
+            os.fsync(dest.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def write_hashed(dest: BinaryIO, digest: Any, buffer: bytes) -> None:
+    """Blocking: one step of a streamed upload, hashlib releases the GIL for large buffers."""
+    digest.update(buffer)
+    dest.write(buffer)
+
+
+def copy_range(source_fd: int, source_offset: int, dest_fd: int, dest_offset: int, length: int,
+               chunk_size: int) -> None:
+    """Blocking: copies length bytes between files at the given offsets.
+
+    copy_file_range stays in the kernel and shares extents where the filesystem can (btrfs, XFS),
+    other filesystems fall back to pread/pwrite.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    while length:
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(source_fd, dest_fd, length, source_offset, dest_offset)
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                copy_file_range = None
+                continue
+        else:
+            copied = os.pwrite(dest_fd, os.pread(source_fd, min(length, chunk_size), source_offset), dest_offset)
+        if not copied:
+            raise OSError(errno.EIO, 'Source file ended before the range')
+        source_offset += copied
+        dest_offset += copied
+        length -= copied
+
+
+def hash_chunks(full_file_path: str, manifest: list, chunk_size: int) -> tuple[str, int, list[int]]:
+    """Blocking: hashes the file and every [digest, size] chunk of manifest in one read.
+
+    Returns (digest, size, offsets of the chunks whose content does not match the manifest).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    mismatched = []
+    with open(full_file_path, 'rb') as fileobj:
+        for chunk_digest, length in manifest:
+            chunk_hash = hashlib.sha256()
+            offset = size
+            remaining = length
+            while remaining and (data := fileobj.read(min(remaining, chunk_size))):
+                digest.update(data)
+                chunk_hash.update(data)
+                size += len(data)
+                remaining -= len(data)
+            if remaining or chunk_hash.hexdigest() != chunk_digest:
+                mismatched.append(offset)
+    return digest.hexdigest(), size, mismatched
+
+
+def copy_fileobj_atomic(fileobj: BinaryIO, full_file_path: str, chunk_size: int) -> None:
+    """Copies into a temp file next to full_file_path, fsyncs it and renames it into place.
+
+    Readers see either the previous file or the complete new one, never a partial write.
+    """
+    directory = os.path.dirname(full_file_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, 'wb') as dest:
+            fileobj.seek(0)
+            while chunk := fileobj.read(chunk_size):
+                dest.write(chunk)
+            dest.flush()
+            os.fsync(dest.fileno())
+        os.replace(tmp_path, full_file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ArchiveSink(io.RawIOBase):
+    """Non-seekable write target collecting archive output until it is drained."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _log_entries(entries: Iterable[tuple[str, str]]) -> Iterator[tuple[str, str]]:
+    sampler = LogSampler(first=settings.log_archive_entries_first, every=settings.log_archive_entries_every)
+    for filepath, arcname in entries:
+        if sampler():
+            logger.info(f'Add to archive {arcname} from {filepath} (file {sampler.seen})')
+        yield filepath, arcname
+    logger.info(f'Added {sampler.seen} files to archive')
+
+
+def _iter_chunks(src: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    while chunk := src.read(chunk_size):
+        yield chunk
+
+
+def iter_zip(entries: Iterable[tuple[str, str]], chunk_size: int) -> Iterator[bytes]:
+    sink = ArchiveSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_io:
+        for filepath, arcname in entries:
+            try:
+                src = open(filepath, 'rb')
+            except FileNotFoundError:
+                logger.error(f'Error add to arch file not found {filepath}')
+                continue
+            with src:
+                zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with zip_io.open(zinfo, 'w', force_zip64=True) as dest:
+                    for chunk in _iter_chunks(src, chunk_size):
+                        dest.write(chunk)
+                        if data := sink.drain():
+                            yield data
+    yield sink.drain()
+
+
+def iter_tar_gz(entries: Iterable[tuple[str, str]], chunk_size: int) -> Iterator[bytes]:
+    sink = ArchiveSink()
+    with gzip.GzipFile(fileobj=sink, mode='wb') as gz:
+        for filepath, arcname in entries:
+            try:
+                src = open(filepath, 'rb')
+            except FileNotFoundError:
+                logger.error(f'Error add to arch file not found {filepath}')
+                continue
+            with src:
+                stat = os.fstat(src.fileno())
+                tarinfo = tarfile.TarInfo(arcname)
+                tarinfo.size = stat.st_size
+                tarinfo.mtime = stat.st_mtime
+                tarinfo.mode = stat.st_mode & 0o7777
+                gz.write(tarinfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+                remaining = tarinfo.size
+                while remaining and (chunk := src.read(min(chunk_size, remaining))):
+                    gz.write(chunk)
+                    remaining -= len(chunk)
+                    if data := sink.drain():
+                        yield data
+                if remaining:
+                    # file shrank while archiving, keep the header honest
+                    gz.write(tarfile.NUL * remaining)
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+            if remainder:
+                gz.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        # end-of-archive marker, padded up to a full record like tarfile does
+        gz.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        gz.write(tarfile.NUL * (-gz.tell() % tarfile.RECORDSIZE))
+    yield sink.drain()
+
+
+def iter_7z(entries: Iterable[tuple[str, str]], chunk_size: int) -> Iterator[bytes]:
+    # 7z writes its header at the end and seeks back, so it can only be spooled
+    with tempfile.SpooledTemporaryFile(max_size=settings.archive_spool_max_size) as spool:
+        with py7zr.SevenZipFile(spool, 'w') as seven_zip:
+            for filepath, arcname in entries:
+                seven_zip.write(filepath, arcname)
+        spool.seek(0)
+        while chunk := spool.read(chunk_size):
+            yield chunk
+
+
+ARCHIVERS: dict[str, tuple[Callable, str]] = {
+    'zip': (iter_zip, 'application/x-zip-compressed'),
+    'tar': (iter_tar_gz, 'application/x-gtar'),
+    '7z': (iter_7z, 'application/x-7z-compressed'),
+}
+
+
+def archive_name(compress_type: str) -> str:
+    return f'archive_{datetime.now().timestamp()}.{compress_type}'
+
+
+def build_archive(compress_type: str, entries: list[tuple[str, str]], chunk_size: int) -> Iterator[bytes]:
+    archiver, _ = ARCHIVERS[compress_type]
+    return archiver(_log_entries(entries), chunk_size)
+
+
+CONTENT_ENCODINGS = ('zstd', 'gzip')
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Picks the first of CONTENT_ENCODINGS the client accepts with q > 0, None for identity."""
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in CONTENT_ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+class ContentEncoder:
+    """Compresses a streamed body piece by piece, flushing each so the client can decode it on arrival."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self._compressor = pyzstd.ZstdCompressor() if encoding == 'zstd' else zlib.compressobj(wbits=31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'zstd':
+            return self._compressor.compress(data, pyzstd.ZstdCompressor.FLUSH_BLOCK)
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+async def encode_stream(chunks: AsyncIterable[bytes], encoding: str) -> AsyncIterator[bytes]:
+    encoder = ContentEncoder(encoding)
+    async for chunk in chunks:
+        if data := await run_in_threadpool(encoder.compress, chunk):
+            yield data
+    yield encoder.finish()
+
+
+def content_disposition(filename: str) -> str:
+    return f"attachment; filename*=utf-8''{quote(filename)}"
 
 
 def is_valid_uuid(uuid_to_test, version=4):